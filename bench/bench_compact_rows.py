@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Compare Comment.findAll() decoding into Model (dict) instances and into compact rows,
+from DictCursor dicts and from plain cursor tuples.
+
+Rows are generated in memory as the tuples the cursor returns, the dict modes also build
+the per-row dict the DictCursor would, so no database is needed. Run from the project root: python3 bench/bench_compact_rows.py
+'''
+
+import os, sys, time, timeit, tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from www.models import Comment, next_id
+
+N = 10000
+
+def make_rows(n):
+    blog_id = next_id()
+    return [dict(id=next_id(), blog_id=blog_id, blog_name='Blog %s' % (i % 50), user_id=next_id(),
+                 user_name='user%s' % i, user_image='http://www.gravatar.com/avatar/%032x?d=mm&s=120' % i,
+                 content='comment content %s' % i, created_at=time.time()) for i in range(n)]
+
+def decode_model(rs):
+    # DictCursor为每行构造一个dict
+    names = Comment.__columns__
+    return [Comment._fromRow(dict(zip(names, r))) for r in rs]
+
+def decode_compact(rs):
+    names = Comment.__columns__
+    row = Comment.__row__
+    return [row._fromDict(dict(zip(names, r))) for r in rs]
+
+def decode_model_tuple(rs):
+    names = Comment.__columns__
+    return [Comment._fromTuple(names, r) for r in rs]
+
+def decode_compact_tuple(rs):
+    names = Comment.__columns__
+    row = Comment.__row__
+    return [row._fromTuple(names, r) for r in rs]
+
+def measure_memory(decode, rs):
+    tracemalloc.start()
+    objs = decode(rs)
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objs
+    return size
+
+def read_all(objs):
+    for c in objs:
+        c.user_name, c.user_image, c.created_at, c.content
+
+def main():
+    dicts = make_rows(N)
+    tuples = [tuple(r[k] for k in Comment.__columns__) for r in dicts]
+    print('%s comments' % N)
+    print('%-16s %14s %14s %14s' % ('mode', 'memory(KB)', 'decode(ms)', 'getattr(ms)'))
+    modes = (
+        ('model/dict', decode_model, tuples),
+        ('compact/dict', decode_compact, tuples),
+        ('model/tuple', decode_model_tuple, tuples),
+        ('compact/tuple', decode_compact_tuple, tuples)
+    )
+    for name, decode, rs in modes:
+        memory = measure_memory(decode, rs)
+        t_decode = min(timeit.repeat(lambda: decode(rs), number=1, repeat=20))
+        objs = decode(rs)
+        t_read = min(timeit.repeat(lambda: read_all(objs), number=1, repeat=20))
+        print('%-16s %14.1f %14.2f %14.2f' % (name, memory / 1024, t_decode * 1000, t_read * 1000))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Measure the per-request overhead of RequestHandler: extracting the arguments of a handler
+with the generic code used before (legacy_kw) and with the binder made by coroweb.make_binder.
+
+Requests are built with aiohttp.test_utils.make_mocked_request, handlers do nothing,
+so no server or database is needed. Run from the project root: python3 bench/bench_dispatch.py
+'''
+
+import os, sys, asyncio, time
+from urllib import parse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+
+from www.coroweb import make_binder, get_named_kw_args, get_required_kw_args, has_var_kw_arg, has_request_arg
+
+# make_mocked_request很慢(约3ms)且占内存，请求数不宜太多
+N = 2000
+
+async def api_blogs(*, page=1, cursor=None):
+    pass
+
+async def api_get_blog(*, id):
+    pass
+
+async def api_comments_by_blog(id, request):
+    pass
+
+def make_legacy(fn):
+    # RequestHandler.__call__之前的实现，签名信息和以前一样事先算好，每个请求都重新判断
+    named = get_named_kw_args(fn)
+    required = get_required_kw_args(fn)
+    var_kw = has_var_kw_arg(fn)
+    with_request = has_request_arg(fn)
+
+    async def bind(request):
+        kw = None
+        if var_kw or named or required:
+            if request.method == 'GET':
+                qs = request.query_string
+                if qs:
+                    kw = dict()
+                    for k, v in parse.parse_qs(qs, True).items():
+                        kw[k] = v[0]
+        if kw is None:
+            kw = dict(**request.match_info)
+        else:
+            if not var_kw and named:
+                copy = dict()
+                for name in named:
+                    if name in kw:
+                        copy[name] = kw[name]
+                kw = copy
+            for k, v in request.match_info.items():
+                kw[k] = v
+        if with_request:
+            kw['request'] = request
+        for name in required:
+            if not name in kw:
+                return web.HTTPBadRequest('Missing argument: %s' % name)
+        return kw
+
+    return bind
+
+CASES = (
+    ('query', api_blogs, '/api/blogs?page=3&foo=bar', {}),
+    ('required', api_get_blog, '/api/blog?id=0014800000001', {}),
+    ('match_info', api_comments_by_blog, '/api/blogs/0014800000001/comments', {'id': '0014800000001'}),
+)
+
+async def run(bind, requests):
+    t = time.time()
+    for request in requests:
+        await bind(request)
+    return time.time() - t
+
+def make_requests(url, match_info):
+    # 每次用新的request，request.query解析后会缓存在request中
+    return [make_mocked_request('GET', url, match_info=match_info) for i in range(N)]
+
+async def main():
+    print('%s requests per case, us per request:' % N)
+    print('    %-12s %10s %10s' % ('case', 'legacy', 'binder'))
+    for name, fn, url, match_info in CASES:
+        legacy = await run(make_legacy(fn), make_requests(url, match_info))
+        binder = await run(make_binder(fn, 'GET'), make_requests(url, match_info))
+        print('    %-12s %10.2f %10.2f' % (name, legacy / N * 1e6, binder / N * 1e6))
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main())
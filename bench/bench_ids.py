@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Compare the legacy 50 chars ids with 64-bit snowflake ids: generation speed,
+insert throughput and index size of a comments-like table.
+
+Snowflake ids are stored as decimal strings in the existing varchar columns, the layout the
+app supports (see www/ids.py); bigint keys are only measured as a reference.
+Uses the sqlite3 module of the standard library so no database server is needed,
+absolute numbers differ from InnoDB but the key size ratio is the same. sqlite stores
+varchar(50) and varchar(20) the same way: the size depends on the length of the values.
+Run from the project root: python3 bench/bench_ids.py
+'''
+
+import os, sys, time, timeit, sqlite3, tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from www.ids import Snowflake, legacy_id
+
+N = 100000
+BLOGS = 100
+
+def make_rows(new_id):
+    blog_ids = [new_id() for i in range(BLOGS)]
+    return [(new_id(), blog_ids[i % BLOGS], 'user%s' % i, 'comment content %s' % i, time.time()) for i in range(N)]
+
+def insert(path, key_type, rows):
+    db = sqlite3.connect(path)
+    # WITHOUT ROWID: 和InnoDB一样按主键聚簇存储
+    db.execute('create table comments (id %s not null primary key, blog_id %s not null, user_name varchar(50) not null, content text not null, created_at real not null) without rowid' % (key_type, key_type))
+    db.execute('create index idx_comments_blog_id_created_at on comments (blog_id, created_at)')
+    t = time.time()
+    with db:
+        db.executemany('insert into comments values (?, ?, ?, ?, ?)', rows)
+    elapsed = time.time() - t
+    db.execute('vacuum')
+    db.close()
+    return elapsed, os.path.getsize(path)
+
+def main():
+    snowflake = Snowflake(1)
+    print('generate %s ids:' % N)
+    print('    legacy:    %.1f ms' % (timeit.timeit(legacy_id, number=N) * 1000))
+    print('    snowflake: %.1f ms' % (timeit.timeit(snowflake.next, number=N) * 1000))
+    print('insert %s comments (%s blogs):' % (N, BLOGS))
+    print('    %-12s %14s %14s' % ('scheme', 'rows/s', 'size(KB)'))
+    with tempfile.TemporaryDirectory() as tmp:
+        snowflake_str = lambda: str(snowflake.next())
+        for name, key_type, new_id in (('legacy', 'varchar(50)', legacy_id),
+                                       ('snowflake', 'varchar(50)', snowflake_str),
+                                       ('bigint(ref)', 'bigint', snowflake.next)):
+            rows = make_rows(new_id)
+            elapsed, size = insert(os.path.join(tmp, '%s.db' % name), key_type, rows)
+            print('    %-12s %14.0f %14.1f' % (name, N / elapsed, size / 1024))
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,105 @@
 #测试服
 configs = {
     'db': {
+        # mysql或sqlite，sqlite时database是数据库文件的路径，不需要host等配置
+        'engine': 'mysql',
         'host': '127.0.0.1',
         'port': 3306,
         'user': 'root',
         'password': '123456',
-        'database': 'awesome'
+        'database': 'awesome',
+        'minsize': 1,
+        'maxsize': 10,
+        # 等待连接的超时时间(秒)，None表示一直等待
+        'acquire_timeout': 10,
+        # 根据等待连接的时间在min和max之间调整可用连接数
+        'adaptive': {
+            'enabled': False,
+            'min': 2,
+            'max': 30,
+            'interval': 5,
+            'grow_wait': 0.05,
+            'shrink_wait': 0.005
+        },
+        # 查询结果缓存，写操作按表失效
+        'query_cache': {
+            'enabled': False,
+            'ttl': 30,
+            'max_entries': 1000,
+            'max_bytes': 16 * 1024 * 1024
+        },
+        # 慢查询日志: 超过threshold秒的语句记录到/manage/queries，按explain_sample的比例抓取EXPLAIN
+        'slow_query': {
+            'threshold': 0.1,
+            'explain_sample': 0.1,
+            'buffer_size': 200
+        },
+        # 只读副本，没写的项沿用上面主库的配置，例如 [{'host': '192.168.0.101'}]
+        'replicas': [],
+        # round_robin 或 least_busy
+        'replica_policy': 'round_robin',
+        # 写操作后这段时间(秒)内同一个请求/用户继续读主库
+        'sticky_seconds': 5,
+        # 在table_versions表中记录各表的版本号，所有进程的ETag一致，需要先用 python3 -m www.schema --diff 建表
+        'table_versions': True
+    },
+    # 日志经队列由后台线程写出，sample是各类日志的采样比例(0~1)，警告不采样
+    'logging': {
+        'level': 'INFO',
+        # json或text
+        'format': 'json',
+        # None表示输出到stderr
+        'file': None,
+        # 队列满时丢弃日志，不阻塞请求
+        'queue_size': 10000,
+        'sample': {
+            'sql': 0.01,
+            'request': 0.1,
+            'handler': 0.01
+        }
     },
     'session': {
-        'secret': 'AwEsOme'
+        # 旧格式cookie(id-expires-sha1)的密钥
+        'secret': 'AwEsOme',
+        # 签名session token的密钥: key id -> 密钥，用key_id签名，用keys中任何一个验证
+        'keys': {
+            'k1': 'AwEsOme-k1'
+        },
+        'key_id': 'k1',
+        # 旧格式cookie接受到这个时间(unix时间)，None表示一直接受
+        'legacy_until': None,
+        # 已登录用户在进程内缓存的秒数和条数，0表示不缓存
+        'cache_ttl': 60,
+        'cache_size': 10000,
+        # 这些路径不检查登录
+        'public_prefixes': ['/static/', '/favicon.ico']
+    },
+    'ids': {
+        # legacy: 50位字符串；snowflake: 64位可按时间排序的id，见www/ids.py中的迁移步骤
+        'scheme': 'legacy',
+        # 0-1023，每个进程必须不同
+        'worker_id': 0
+    },
+    # 匿名用户访问首页和日志页的整页缓存，写操作按tag失效
+    'page_cache': {
+        'enabled': True,
+        'ttl': 60,
+        'max_bytes': 32 * 1024 * 1024,
+        # 超过这个大小的页面不缓存
+        'max_entry_bytes': 512 * 1024
+    },
+    'markdown': {
+        # 进程内LRU缓存的条目数
+        'cache_size': 512,
+        # 为True时把渲染结果写入blogs.html_content列，需要先执行:
+        # alter table blogs add column `html_content` mediumtext;
+        'persist': False,
+        # 渲染进程池的大小，为0时全部在事件循环内渲染
+        'workers': 2,
+        # 小于该长度(字符数)的文本直接在事件循环内渲染
+        'inline_threshold': 4096,
+        # 进程池渲染的超时时间(秒)，超时后返回转义后的纯文本
+        'timeout': 2.0
     }
 
-}
\ No newline at end of file
+}
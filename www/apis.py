@@ -3,7 +3,7 @@
 JSON API definition.
 '''
 
-import json, logging, inspect, functools
+import json, logging, inspect, functools, base64
 
 class Page(object):
     '''
@@ -36,6 +36,9 @@ class Page(object):
         >>> p3.limit
         10
         '''
+        if item_count is None:
+            self._init_count_free(page_index, page_size)
+            return
         self.item_count = item_count
         self.page_size = page_size
         self.page_count = item_count // page_size + (1 if item_count % page_size > 0 else 0)
@@ -50,11 +53,147 @@ class Page(object):
         self.has_next = self.page_index < self.page_count
         self.has_previous = self.page_index > 1
 
+    def _init_count_free(self, page_index, page_size):
+        '''
+        Init Pagination without item_count: limit is one more than page_size,
+        and has_next is decided by trim() from the rows actually fetched.
+
+        >>> p = Page(None, 2, 3)
+        >>> p.offset, p.limit
+        (3, 4)
+        >>> p.trim([1, 2, 3, 4])
+        [1, 2, 3]
+        >>> p.has_next, p.has_previous
+        (True, True)
+        >>> Page(None, 1, 3).trim([1, 2])
+        [1, 2]
+        '''
+        self.item_count = None
+        self.page_count = None
+        self.page_size = page_size
+        self.page_index = page_index
+        self.offset = page_size * (page_index - 1)
+        self.limit = page_size + 1
+        self.has_next = False
+        self.has_previous = page_index > 1
+
+    def trim(self, items):
+        '''
+        Drop the extra row fetched in count-free mode and set has_next.
+        '''
+        self.has_next = len(items) > self.page_size
+        return items[:self.page_size]
+
+    def set_item_count(self, item_count):
+        '''
+        Fill item_count and page_count of a count-free page, e.g. from findNumberCached().
+
+        >>> p = Page(None, 1)
+        >>> p.set_item_count(91)
+        >>> p.page_count
+        10
+        '''
+        if item_count is None:
+            return
+        self.item_count = item_count
+        self.page_count = item_count // self.page_size + (1 if item_count % self.page_size > 0 else 0)
+
     def __str__(self):
         return 'item_count: %s, page_count: %s, page_index: %s, page_size: %s, offset: %s, limit: %s' % (self.item_count, self.page_count, self.page_index, self.page_size, self.offset, self.limit)
 
     __repr__ = __str__
 
+def encode_cursor(direction, key):
+    '''
+    Encode direction ('next' or 'prev') and seek key to an opaque url-safe token.
+    '''
+    s = json.dumps([direction] + list(key), separators=(',', ':'))
+    return base64.urlsafe_b64encode(s.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    '''
+    Decode token made by encode_cursor, returns (direction, key).
+
+    >>> decode_cursor(encode_cursor('next', (1480000000.5, '0014800000005')))
+    ('next', (1480000000.5, '0014800000005'))
+    '''
+    try:
+        s = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        L = json.loads(s)
+        if not isinstance(L, list) or len(L) != 3 or L[0] not in ('next', 'prev'):
+            raise ValueError('bad cursor')
+        return L[0], (L[1], L[2])
+    except ValueError:
+        raise APIValuaError('cursor', 'Invalid cursor.')
+
+class CursorPage(object):
+    '''
+    Page object for keyset pagination, the cost of every page is the same as the first one.
+    '''
+
+    def __init__(self, cursor=None, page_size=10, seek_by='created_at'):
+        '''
+        Init Pagination by cursor token (None or '' for the first page) and page_size.
+
+        >>> p1 = CursorPage()
+        >>> p1.limit, p1.after, p1.before
+        (11, None, None)
+        >>> p2 = CursorPage(encode_cursor('prev', (2.0, 'b')), 2)
+        >>> p2.limit, p2.after, p2.before
+        (3, None, (2.0, 'b'))
+        '''
+        self.page_size = page_size
+        self.seek_by = seek_by
+        self.after = None
+        self.before = None
+        direction = None
+        if cursor:
+            direction, key = decode_cursor(cursor)
+            if direction == 'next':
+                self.after = key
+            else:
+                self.before = key
+        self._direction = direction
+        # 多取一行用来判断这个方向上是否还有数据
+        self.limit = page_size + 1
+        self.has_next = False
+        self.has_previous = False
+        self.next_cursor = None
+        self.previous_cursor = None
+
+    def trim(self, items, pk='id'):
+        '''
+        Trim the extra row fetched by limit, set has_next/has_previous and the cursors.
+
+        >>> p = CursorPage(page_size=2)
+        >>> items = p.trim([dict(id='c', created_at=3.0), dict(id='b', created_at=2.0), dict(id='a', created_at=1.0)])
+        >>> [i['id'] for i in items], p.has_next, p.has_previous
+        (['c', 'b'], True, False)
+        >>> decode_cursor(p.next_cursor)
+        ('next', (2.0, 'b'))
+        '''
+        more = len(items) > self.page_size
+        if self._direction == 'prev':
+            # before查询的多余行在最前面
+            items = items[-self.page_size:] if more else items
+            self.has_previous = more
+            self.has_next = True
+        else:
+            items = items[:self.page_size]
+            self.has_next = more
+            self.has_previous = self._direction == 'next'
+        if items:
+            if self.has_next:
+                self.next_cursor = encode_cursor('next', (items[-1][self.seek_by], items[-1][pk]))
+            if self.has_previous:
+                self.previous_cursor = encode_cursor('prev', (items[0][self.seek_by], items[0][pk]))
+        return items
+
+    def __str__(self):
+        return 'page_size: %s, after: %s, before: %s, has_next: %s, has_previous: %s' % (self.page_size, self.after, self.before, self.has_next, self.has_previous)
+
+    __repr__ = __str__
+
 class APIError(Exception):
     '''
         the base APIError which contains error(required), data(optional) and message(optional).
@@ -1,17 +1,24 @@
-import logging; logging.basicConfig(level=logging.INFO)
+import logging
 
-import asyncio, os, json, time
+import asyncio, os, json, time, hashlib
 from datetime import datetime
+from email.utils import formatdate, parsedate_to_datetime
 
 from aiohttp import web
 from jinja2 import Environment, FileSystemLoader
 
 from www.coroweb import add_routes, add_static
 import www.orm
+import www.render
+import www.logs
+import www.session
+import www.pagecache
 
 import conf.config
 
-from www.handlers import COOKIE_NAME, cookie2user
+_request_log = www.logs.get_logger('request')
+
+from www.handlers import COOKIE_NAME, cookie2user, user2cookie, legacy_cookie_expires
 
 def init_jinja2(app, **kw):
     logging.info('init jinja2...')
@@ -36,25 +43,45 @@ def init_jinja2(app, **kw):
 
 async def logger_factory(app, handler):
     async def logger(request):
-        logging.info('Request: %s %s' % (request.method, request.path))
-        return (await handler(request))
+        # 请求完成后记录一行，包括状态码和耗时
+        t = time.time()
+        status = 500
+        try:
+            r = await handler(request)
+            status = getattr(r, 'status', 200)
+            return r
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            _request_log.info('%s %s', request.method, request.path, status=status, duration=round((time.time() - t) * 1000, 3))
     return logger
 
 @asyncio.coroutine
 def auth_factory(app, handler):
     @asyncio.coroutine
     def auth(request):
-        logging.info('check user: %s %s' % (request.method, request.path))
         request.__user__ = None
+        if www.session.is_public(request.path):
+            return (yield from handler(request))
         cookie_str = request.cookies.get(COOKIE_NAME)
+        upgrade = None
         if cookie_str:
             user = yield from cookie2user(cookie_str)
             if user:
-                logging.info('set current user: %s' % user.email)
+                _request_log.debug('set current user: %s', user.id)
                 request.__user__ = user
+                www.orm.set_sticky_key(user.id)
+                # 旧格式的cookie换成session token，有效期不变
+                expires = legacy_cookie_expires(cookie_str)
+                if expires is not None:
+                    upgrade = user2cookie(user, expires - time.time())
         if request.path.startswith('/manage/') and (request.__user__ is None or not request.__user__.admin):
             return web.HTTPFound('/signin')
-        return (yield from handler(request))
+        r = yield from handler(request)
+        if upgrade is not None and isinstance(r, web.StreamResponse) and not r.prepared and COOKIE_NAME not in r.cookies:
+            r.set_cookie(COOKIE_NAME, upgrade, max_age=int(expires - time.time()), httponly=True)
+        return r
     return auth
 
 async def data_factory(app, handler):
@@ -62,16 +89,120 @@ async def data_factory(app, handler):
         if request.method == 'POST':
             if request.content_type.startswith('application/json'):
                 request.__data__ = await request.json()
-                logging.info('request json: %s' % str(request.__data__))
+                _request_log.debug('request json: %s', sorted(request.__data__.keys()))
             elif request.content_type.startswith('application/x-www-form-urlencoded'):
                 request.__data__ = await request.post()
-                logging.info('request form: %s' % str(request.__data__))
+                _request_log.debug('request form: %s', sorted(request.__data__.keys()))
         return (await handler(request))
     return parse_data
 
+async def page_cache_factory(app, handler):
+    async def page_cache(request):
+        if request.method != 'GET' or not www.pagecache.enabled():
+            return (await handler(request))
+        tag = www.pagecache.tag_of(request.path)
+        user_class = www.pagecache.user_class(request)
+        if tag is None or user_class is None:
+            return (await handler(request))
+        key = (request.path, request.query_string, user_class)
+
+        async def render():
+            r = await handler(request)
+            page = None
+            # 只缓存没有设置cookie、也没有标记no-store(例如markdown超时用了纯文本)的200响应
+            if isinstance(r, web.Response) and r.status == 200 and isinstance(r.body, bytes) and not r.cookies \
+                    and 'no-store' not in r.headers.get('Cache-Control', ''):
+                page = www.pagecache.CachedPage(r.status, r.content_type, r.charset, r.body, tag, time.time() + www.pagecache.cache().ttl,
+                                                r.headers.get('ETag'), r.headers.get('Last-Modified'))
+            return page, r
+
+        page, r = await www.pagecache.cache().get_or_render(key, tag, render)
+        if r is not None:
+            return r
+        if page is None:
+            # 等待的页面不能缓存，自己再处理一次
+            return (await handler(request))
+        if page.etag is not None:
+            last_modified = parsedate_to_datetime(page.last_modified).timestamp()
+            if is_not_modified(request, page.etag, last_modified):
+                return set_validators(web.Response(status=304), page.etag, last_modified, False)
+        resp = web.Response(status=page.status, body=page.body, content_type=page.content_type, charset=page.charset)
+        if page.etag is not None:
+            set_validators(resp, page.etag, last_modified, False)
+        resp.headers['X-Page-Cache'] = 'HIT'
+        return resp
+    return page_cache
+
+def _max_created_at(r):
+    # 返回的Model、Row及其列表中最大的created_at
+    t = 0
+    for v in r.values():
+        items = v if isinstance(v, list) else (v,)
+        for item in items:
+            if isinstance(item, (dict, www.orm.Row)):
+                created_at = item.get('created_at')
+                if isinstance(created_at, (int, float)) and created_at > t:
+                    t = created_at
+    return t
+
+def validators(request, r, tables, versions=None):
+    '''
+    Return (etag, last_modified) of the dict r returned by a handler, computed from the versions
+    of the tables read while handling the request and the created_at of the returned rows.
+    versions are the shared table versions read before the handler ran. Without them the table
+    versions only count the writes of this process, so the validators also change every
+    configs.page_cache.ttl seconds: writes of other processes are seen after at most ttl.
+    '''
+    token, modified = www.orm.tables_version(tables, versions)
+    created_at = _max_created_at(r)
+    bucket = 0
+    if versions is None:
+        ttl = max(1, conf.config.configs['page_cache']['ttl'])
+        # 当前ttl时间段的开始时间
+        bucket = int(time.time() // ttl) * ttl
+    user = request.__user__
+    who = '' if user is None else '%s:%s:%s:%s' % (user.id, user.name, user.image, user.admin)
+    s = '%s|%s|%s|%s|%s' % (r.get('__template__', ''), who, token, bucket, created_at)
+    etag = '"%s"' % hashlib.sha1(s.encode('utf-8')).hexdigest()
+    return etag, max(modified, created_at, bucket)
+
+def is_not_modified(request, etag, last_modified):
+    # 有If-None-Match时只比较ETag
+    inm = request.headers.get('If-None-Match')
+    if inm is not None:
+        tags = [t.strip() for t in inm.split(',')]
+        return '*' in tags or etag in tags or ('W/' + etag) in tags
+    ims = request.headers.get('If-Modified-Since')
+    if ims is not None:
+        try:
+            return int(last_modified) <= parsedate_to_datetime(ims).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def set_validators(resp, etag, last_modified, private):
+    resp.headers['ETag'] = etag
+    resp.headers['Last-Modified'] = formatdate(last_modified, usegmt=True)
+    # 每次都要带着validators重新验证；登录用户的页面CDN等共享缓存不能保存
+    resp.headers['Cache-Control'] = 'private, no-cache' if private else 'public, no-cache'
+    # 内容与登录的用户有关
+    resp.headers['Vary'] = 'Cookie'
+    return resp
+
+def json_default(o):
+    # 紧凑模式的Row没有__dict__
+    if hasattr(o, '_asdict'):
+        return o._asdict()
+    return o.__dict__
+
 async def response_factory(app, handler):
     async def response(request):
-        logging.info('Response handler...')
+        versions = None
+        if request.method in ('GET', 'HEAD') and not www.session.is_public(request.path):
+            # 先读版本号再读数据，期间的写操作只会让ETag变旧，不会把旧数据当成新版本
+            versions = await www.orm.table_versions()
+        tables = www.orm.track_reads()
+        fallbacks = www.render.track_fallbacks()
         r = await handler(request)
         if isinstance(r, web.StreamResponse):
             return r
@@ -86,16 +217,28 @@ async def response_factory(app, handler):
             resp.content_type = 'text/html;charset=utf-8'
             return resp
         if isinstance(r, dict):
+            etag = None
+            # 没有读过任何表的响应(例如/manage/metrics)无法判断是否变化，不发validators
+            if request.method in ('GET', 'HEAD') and 'error' not in r and tables and not fallbacks:
+                etag, last_modified = validators(request, r, tables, versions)
+                private = request.__user__ is not None
+                # 内容没有变化，不渲染模板也不编码json
+                if is_not_modified(request, etag, last_modified):
+                    return set_validators(web.Response(status=304), etag, last_modified, private)
             template = r.get('__template__')
             if template is None:
-                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
+                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=json_default).encode('utf-8'))
                 resp.content_type = 'application/json;charset=utf-8'
-                return resp
             else:
                 r['__user__'] = request.__user__
                 resp = web.Response(body=app['__templating__'].get_template(template).render(**r).encode('utf-8'))
                 resp.content_type = 'text/html;charset=utf-8'
-                return resp
+            if etag is not None:
+                set_validators(resp, etag, last_modified, private)
+            elif fallbacks:
+                # markdown超时用了纯文本，不能被任何缓存保存
+                resp.headers['Cache-Control'] = 'no-store'
+            return resp
         if isinstance(r, int) and r >= 100 and r < 600:
             return web.Response(r)
         if isinstance(r, tuple) and len(r) == 2:
@@ -130,8 +273,9 @@ async def init(loop):
         raise ValueError('configs must be a dict')
     db = configs['db']
     await www.orm.create_pool(loop, **db)
+    www.render.init_executor()
     app = web.Application(loop=loop, middlewares=[
-        logger_factory, auth_factory, response_factory
+        logger_factory, auth_factory, page_cache_factory, response_factory
     ])
     #app.router.add_route('GET', '/', index)
     init_jinja2(app, filters=dict(datetime=datetime_filter))
@@ -141,6 +285,9 @@ async def init(loop):
     logging.info('server started at http://127.0.0.1:9000...')
     return srv
 
-loop = asyncio.get_event_loop()
-loop.run_until_complete(init(loop))
-loop.run_forever()
\ No newline at end of file
+# markdown进程池的子进程会以__mp_main__重新导入本模块，不能再次启动服务器
+if __name__ == '__main__':
+    www.logs.setup(conf.config.configs['logging'])
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(init(loop))
+    loop.run_forever()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Database drivers used by orm.
+
+The orm writes every statement with '?' placeholders; each driver converts them to the style of
+its database and exposes the same coroutines on a raw connection:
+
+    create_pool, fetch, run, iter_chunks, begin, commit, rollback, discard, explain_sql
+
+Select the driver with configs.db.engine: 'mysql' (aiomysql) or 'sqlite' (the sqlite3 module of
+the standard library, run in one worker thread per connection, database is a file path).
+'''
+
+__author__ = 'wang shi wen'
+
+import asyncio, logging, sqlite3, collections
+from concurrent.futures import ThreadPoolExecutor
+
+class MySQLBackend(object):
+
+    name = 'mysql'
+
+    def __init__(self):
+        # 只有使用MySQL时才需要安装aiomysql
+        import aiomysql
+        self.aiomysql = aiomysql
+
+    async def create_pool(self, loop, kw, maxsize):
+        return await self.aiomysql.create_pool(
+            host=kw.get('host', 'localhost'),
+            port=kw.get('port', 3306),
+            user=kw.get('user'),
+            password=kw.get('password'),
+            db=kw.get('database'),
+            charset=kw.get('charset', 'utf8'),
+            autocommit=kw.get('autocommit', True),
+            maxsize=maxsize,
+            minsize=kw.get('minsize', 1),
+            loop=loop
+        )
+
+    def sql(self, sql):
+        # SQL语句的占位符为?，MySQL的占位符为%s
+        return sql.replace('?', '%s')
+
+    async def fetch(self, conn, sql, args, size=None, tuples=False):
+        async with conn.cursor(self.aiomysql.Cursor if tuples else self.aiomysql.DictCursor) as cur:
+            await cur.execute(self.sql(sql), args or ())
+            if size:
+                return await cur.fetchmany(size)
+            return await cur.fetchall()
+
+    async def run(self, conn, sql, args):
+        async with conn.cursor() as cur:
+            await cur.execute(self.sql(sql), args or ())
+            return cur.rowcount
+
+    async def iter_chunks(self, conn, sql, args, chunk_size):
+        # 无缓冲的服务端游标(SSCursor)，每次fetchmany一个chunk
+        cur = await conn.cursor(self.aiomysql.SSCursor)
+        await cur.execute(self.sql(sql), args or ())
+        while True:
+            rs = await cur.fetchmany(chunk_size)
+            if not rs:
+                break
+            yield rs
+        await cur.close()
+
+    async def begin(self, conn):
+        await conn.begin()
+
+    async def commit(self, conn):
+        await conn.commit()
+
+    async def rollback(self, conn):
+        await conn.rollback()
+
+    def discard(self, conn):
+        # 结果集没有读完的连接不能再用，关闭后再还给连接池
+        conn.close()
+
+    def explain_sql(self, sql):
+        return 'explain ' + sql
+
+class SQLiteConnection(object):
+    '''
+    A sqlite3 connection bound to its own worker thread, every call is run there.
+    '''
+
+    def __init__(self, database, timeout):
+        self.database = database
+        self.timeout = timeout
+        self.conn = None
+        self.closed = False
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def _open(self):
+        conn = sqlite3.connect(self.database, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+        # WAL模式下读写互不阻塞
+        conn.execute('pragma journal_mode=wal')
+        conn.execute('pragma synchronous=normal')
+        self.conn = conn
+
+    def call(self, fn, *args):
+        return asyncio.get_event_loop().run_in_executor(self._executor, fn, *args)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.conn is not None:
+            self._executor.submit(self.conn.close)
+        self._executor.shutdown(wait=False)
+
+class SQLitePool(object):
+    '''
+    Minimal connection pool with the attributes of aiomysql.Pool used by DbPool.
+    '''
+
+    def __init__(self, database, minsize, maxsize, timeout):
+        self.database = database
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.size = 0
+        self._free = collections.deque()
+        self._cond = asyncio.Condition()
+
+    @property
+    def freesize(self):
+        return len(self._free)
+
+    async def _connect(self):
+        conn = SQLiteConnection(self.database, self.timeout)
+        await conn.call(conn._open)
+        return conn
+
+    async def fill(self):
+        while self.size < self.minsize:
+            self.size = self.size + 1
+            try:
+                self._free.append(await self._connect())
+            except BaseException:
+                self.size = self.size - 1
+                raise
+
+    async def acquire(self):
+        async with self._cond:
+            while True:
+                if self._free:
+                    return self._free.popleft()
+                if self.size < self.maxsize:
+                    self.size = self.size + 1
+                    try:
+                        return await self._connect()
+                    except BaseException:
+                        self.size = self.size - 1
+                        raise
+                await self._cond.wait()
+
+    def release(self, conn):
+        if conn.closed:
+            self.size = self.size - 1
+        else:
+            self._free.append(conn)
+        asyncio.ensure_future(self._notify())
+
+    async def _notify(self):
+        async with self._cond:
+            self._cond.notify()
+
+    async def clear(self):
+        while self._free:
+            self._free.popleft().close()
+            self.size = self.size - 1
+
+class SQLiteBackend(object):
+
+    name = 'sqlite'
+
+    async def create_pool(self, loop, kw, maxsize):
+        database = kw.get('database') or ':memory:'
+        if database == ':memory:':
+            # 每个内存数据库连接都是独立的库，只能用一个连接
+            logging.warning('sqlite in-memory database, use 1 connection.')
+            maxsize = 1
+        pool = SQLitePool(database, min(kw.get('minsize', 1), maxsize), maxsize, kw.get('busy_timeout', 5))
+        await pool.fill()
+        return pool
+
+    def sql(self, sql):
+        # sqlite3本身使用?占位符
+        return sql
+
+    def _fetch(self, conn, sql, args, size, tuples):
+        cur = conn.execute(sql, args or ())
+        try:
+            rs = cur.fetchmany(size) if size else cur.fetchall()
+            if tuples:
+                return rs
+            names = [d[0] for d in cur.description] if cur.description else []
+            return [dict(zip(names, r)) for r in rs]
+        finally:
+            cur.close()
+
+    async def fetch(self, conn, sql, args, size=None, tuples=False):
+        return await conn.call(self._fetch, conn.conn, sql, args, size, tuples)
+
+    def _run(self, conn, sql, args):
+        cur = conn.execute(sql, args or ())
+        try:
+            return cur.rowcount
+        finally:
+            cur.close()
+
+    async def run(self, conn, sql, args):
+        return await conn.call(self._run, conn.conn, sql, args)
+
+    async def iter_chunks(self, conn, sql, args, chunk_size):
+        cur = await conn.call(conn.conn.execute, sql, args or ())
+        try:
+            while True:
+                rs = await conn.call(cur.fetchmany, chunk_size)
+                if not rs:
+                    break
+                yield rs
+        finally:
+            await conn.call(cur.close)
+
+    async def begin(self, conn):
+        # immediate: 开始事务时就拿写锁，避免两个事务都读过后再升级写锁时互相等待
+        await conn.call(conn.conn.execute, 'begin immediate')
+
+    async def commit(self, conn):
+        await conn.call(conn.conn.execute, 'commit')
+
+    async def rollback(self, conn):
+        await conn.call(conn.conn.execute, 'rollback')
+
+    def discard(self, conn):
+        conn.close()
+
+    def explain_sql(self, sql):
+        return 'explain query plan ' + sql
+
+def get_backend(engine):
+    if engine == 'mysql':
+        return MySQLBackend()
+    if engine == 'sqlite':
+        return SQLiteBackend()
+    raise ValueError('Invalid database engine: %s' % engine)
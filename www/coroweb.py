@@ -2,9 +2,11 @@
 # -*- coding: utf-8 -*-
 
 import asyncio, os, inspect, logging, functools
-from urllib import parse
 from  aiohttp import web
 from  www.apis import APIError
+import www.logs
+
+_handler_log = www.logs.get_logger('handler')
 
 def get(path):
     '''
@@ -73,62 +75,145 @@ def has_request_arg(fn):
             raise ValueError('request parameter must be the last named parameter in function: %s%s' % (fn.__name__, str(sig)))
     return found
 
+def _to_bool(s):
+    s = s.lower()
+    if s in ('1', 'true', 'yes', 'on'):
+        return True
+    if s in ('', '0', 'false', 'no', 'off'):
+        return False
+    raise ValueError('not a boolean: %s' % s)
+
+def get_converters(fn):
+    '''
+    Return (name, converter) of the arguments to convert from str,
+    the type is the annotation, or the type of the default value: page=1 is converted by int.
+    '''
+    converters = []
+    for name, param in inspect.signature(fn).parameters.items():
+        t = param.annotation
+        if t is inspect.Parameter.empty and param.default is not inspect.Parameter.empty and param.default is not None:
+            t = type(param.default)
+        if t is bool:
+            converters.append((name, _to_bool))
+        elif t in (int, float):
+            converters.append((name, t))
+    return tuple(converters)
+
+async def _read_query(request, names):
+    # names为None时读取全部参数，同名参数取第一个
+    if not request.query_string:
+        return None
+    query = request.query
+    if names is None:
+        kw = dict()
+        for k, v in query.items():
+            kw.setdefault(k, v)
+        return kw
+    kw = dict()
+    for name in names:
+        v = query.get(name)
+        if v is not None:
+            kw[name] = v
+    return kw
+
+async def _read_body(request, names):
+    if not request.content_type:
+        return web.HTTPBadRequest('Missing Content-Type.')
+    ct = request.content_type.lower()
+    if ct.startswith('application/json'):
+        params = await request.json()
+        if not isinstance(params, dict):
+            return web.HTTPBadRequest('JSON body must be object.')
+    elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
+        params = await request.post()
+    else:
+        return web.HTTPBadRequest('Unsupported Content-Type: %s' % request.content_type)
+    if names is None:
+        return dict(**params)
+    kw = dict()
+    for name in names:
+        if name in params:
+            kw[name] = params[name]
+    return kw
+
+async def _read_any(request, names):
+    if request.method == 'POST':
+        return await _read_body(request, names)
+    if request.method == 'GET':
+        return await _read_query(request, names)
+    return None
+
+def make_binder(fn, method=None, named=None, required=None, var_kw=None, with_request=None):
+    '''
+    Build the coroutine extracting the arguments of fn from a request, once per route.
+    It returns the keyword arguments to call fn with, or a response if the request is bad.
+    The signature data not given (e.g. already computed by RequestHandler) is computed from fn.
+    '''
+    if named is None:
+        named = get_named_kw_args(fn)
+    if required is None:
+        required = get_required_kw_args(fn)
+    if var_kw is None:
+        var_kw = has_var_kw_arg(fn)
+    if with_request is None:
+        with_request = has_request_arg(fn)
+    converters = get_converters(fn)
+    if var_kw:
+        names = None
+    elif named:
+        names = named
+    else:
+        # 没有关键字参数，不需要读取请求参数
+        names = ()
+    read = _read_query if method == 'GET' else _read_body if method == 'POST' else _read_any
+
+    async def bind(request):
+        kw = None
+        if names != ():
+            kw = await read(request, names)
+            if kw is not None and not isinstance(kw, dict):
+                return kw
+        match_info = request.match_info
+        if kw is None:
+            kw = dict(**match_info)
+        elif match_info:
+            for k, v in match_info.items():
+                if k in kw:
+                    logging.warning('Duplicate arg name in named arg and kw args: %s' % k)
+                kw[k] = v
+        for name, convert in converters:
+            v = kw.get(name)
+            if isinstance(v, str):
+                try:
+                    kw[name] = convert(v)
+                except ValueError:
+                    return web.HTTPBadRequest('Invalid argument: %s' % name)
+        if with_request:
+            kw['request'] = request
+        for name in required:
+            if not name in kw:
+                return web.HTTPBadRequest('Missing argument: %s' % name)
+        return kw
+
+    return bind
+
 class RequestHandler(object):
-    def __init__(self, app, fn):
+    def __init__(self, app, fn, method=None):
         self._app = app
         self._func = fn
         self._has_request_arg = has_request_arg(fn)
-        self._has_var_kw_arg = has_var_kw_arg(fn)
-        self._has_named_kw_args = has_named_kw_args(fn)
+        self._has_var_kw_arg = bool(has_var_kw_arg(fn))
         self._named_kw_args = get_named_kw_args(fn)
         self._required_kw_args = get_required_kw_args(fn)
+        # 按路由的方法和函数签名预先生成取参数的函数
+        self._bind = make_binder(fn, method, self._named_kw_args, self._required_kw_args, self._has_var_kw_arg, self._has_request_arg)
 
     async def __call__(self, request):
-        kw = None
-        if self._has_var_kw_arg or self._has_named_kw_args or self._required_kw_args:
-            if request.method == 'POST':
-                if not request.content_type:
-                    return web.HTTPBadRequest('Missing Content-Type.')
-                ct = request.content_type.lower()
-                if ct.startswith('application/json'):
-                    params = await request.json()
-                    if not isinstance(params, dict):
-                        return web.HTTPBadRequest('JSON body must be object.')
-                    kw = params
-                elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
-                    params = await request.post()
-                    kw = dict(**params)
-                else:
-                    return web.HTTPBadRequest('Unsupported Content-Type: %s' % request.content_type)
-            if request.method == 'GET':
-                qs = request.query_string
-                if qs:
-                    kw = dict()
-                    for k, v in parse.parse_qs(qs, True).items():
-                        kw[k] = v[0]
-        if kw is None:
-            kw = dict(**request.match_info)
-        else:
-            if not self._has_var_kw_arg and self._named_kw_args:
-                # remove all unamed kw:
-                copy = dict()
-                for name in self._named_kw_args:
-                    if name in kw:
-                        copy[name] = kw[name]
-                kw = copy
-            # check named arg:
-            for k, v in request.match_info.items():
-                if k in kw:
-                    logging.warning('Duplicate arg name in named arg and kw args: %s' % k)
-                kw[k] = v
-        if self._has_request_arg:
-            kw['request'] = request
-        # check required kw:
-        if self._required_kw_args:
-            for name in self._required_kw_args:
-                if not name in kw:
-                    return web.HTTPBadRequest('Missing argument: %s' % name)
-        logging.info('call with args: %s' % str(kw))
+        kw = await self._bind(request)
+        if not isinstance(kw, dict):
+            return kw
+        # 只记录参数名，参数值可能是密码等敏感数据
+        _handler_log.info('call %s', self._func.__name__, args=sorted(kw.keys()))
         try:
             r = await self._func(**kw)
             return r
@@ -148,7 +233,7 @@ def add_route(app, fn):
     if not asyncio.iscoroutinefunction(fn) and not inspect.isgeneratorfunction(fn):
         fn = asyncio.coroutine(fn)
     logging.info('add route %s %s => %s(%s)' % (method, path, fn.__name__, ', '.join(inspect.signature(fn).parameters.keys())))
-    app.router.add_route(method, path, RequestHandler(app, fn))
+    app.router.add_route(method, path, RequestHandler(app, fn, method))
 
 def add_routes(app, module_name):
     n = module_name.rfind('.')
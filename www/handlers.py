@@ -3,12 +3,16 @@
 import re, time, json, logging, hashlib, base64, asyncio
 from www.coroweb import get, post
 from www.models import User, Comment, Blog, next_id
-from www.apis import Page, APIValuaError, APIResourceNotFoundError, APIPermissionError
+from www.apis import Page, CursorPage, APIValuaError, APIResourceNotFoundError, APIPermissionError
 from conf.config import configs
 
 from aiohttp import web
 
-import www.markdown2
+import www.render
+import www.orm
+import www.logs
+import www.session
+import www.pagecache
 
 def check_admin(request):
     if request.__user__ is None or not request.__user__.admin:
@@ -24,9 +28,11 @@ def get_page_index(page_str):
         p = 1
     return p
 
-def text2html(text):
-    lines = map(lambda s: '<p>%s</p>' % s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;'), filter(lambda s: s.strip() != '', text.split('\n')))
-    return ''.join(lines)
+async def find_cursor_page(cls, cursor, where=None, args=None, columns=None):
+    # 游标分页: cursor为空字符串时返回第一页
+    p = CursorPage(cursor)
+    items = await cls.findAll(where, args, orderBy='created_at desc, id desc', after=p.after, before=p.before, limit=p.limit, columns=columns)
+    return p, p.trim(items)
 
 COOKIE_NAME = 'awesome'
 _COOKIE_KEY = configs['session']['secret']
@@ -35,11 +41,18 @@ def user2cookie(user, max_age):
     '''
        Generate cookie str by user.
        '''
-    # build cookie string by: id-expires-sha1
-    expires = str(int(time.time() + max_age))
-    s = '%s-%s-%s-%s' % (user.id, user.passwd, expires, _COOKIE_KEY)
-    L = [user.id, expires, hashlib.sha1(s.encode('utf-8')).hexdigest()]
-    return '-'.join(L)
+    # 签名的session token，带上模板需要的字段，验证时不用查数据库
+    return www.session.encode_token(user.id, user.name, user.image, user.admin, max_age)
+
+def legacy_cookie_expires(cookie_str):
+    ' return the expiry of a legacy cookie, None if cookie_str is not one. '
+    L = cookie_str.split('-')
+    if len(L) != 3 or not L[1].isdigit():
+        return None
+    return int(L[1])
+
+# token中没有的字段
+_UNLOADED_USER_FIELDS = frozenset(User.__fields__) - frozenset(('name', 'image', 'admin'))
 
 @asyncio.coroutine
 def cookie2user(cookie_str):
@@ -48,14 +61,28 @@ def cookie2user(cookie_str):
     '''
     if not cookie_str:
         return None
+    if cookie_str.startswith(www.session.TOKEN_PREFIX):
+        claims = www.session.decode_token(cookie_str)
+        if claims is None:
+            return None
+        return User._fromRow(dict(id=claims['id'], name=claims['name'], image=claims['image'], admin=claims['admin']),
+                             _UNLOADED_USER_FIELDS)
+    if not www.session.accept_legacy():
+        return None
     try:
+        # 旧格式: id-expires-sha1
         L = cookie_str.split('-')
         if len(L) != 3:
             return None
         uid, expires, sha1 = L
         if int(expires) < time.time():
             return None
-        user = yield from User.find(uid)
+        # 整个cookie作为key，伪造的sha1不会命中缓存
+        key = (uid, expires, sha1)
+        user = www.session.get(key)
+        if user is not None:
+            return user
+        user = yield from User.load(uid)
         if user is None:
             return None
         s = '%s-%s-%s-%s' % (uid, user.passwd, expires, _COOKIE_KEY)
@@ -63,20 +90,16 @@ def cookie2user(cookie_str):
             logging.info('invalid sha1')
             return None
         user.passwd = '******'
+        www.session.put(key, user, int(expires))
         return user
     except Exception as e:
         logging.exception(e)
         return None
 
 @get('/')
-async def index(*, page='1'):
-    page_index = get_page_index(page)
-    num = await Blog.findNumber('count(id)')
-    page = Page(num, page_index)
-    if num == 0:
-        blogs = []
-    else:
-        blogs = await Blog.findAll(orderBy='created_at desc', limit=(page.offset, page.limit))
+async def index(*, page=1):
+    page = Page(None, get_page_index(page))
+    blogs = page.trim(await Blog.findAll(orderBy='created_at desc', limit=(page.offset, page.limit), columns='list'))
     return {
         '__template__': 'blogs.html',
         'page': page,
@@ -108,14 +131,14 @@ def manage():
     return 'redirect:/manage/comments'
 
 @get('/manage/comments')
-def manage_comments(*, page='1'):
+def manage_comments(*, page=1):
     return {
         '__template__': 'manage_comments.html',
         'page_index': get_page_index(page)
     }
 
 @get('/manage/blogs')
-def manage_blogs(*, page='1'):
+def manage_blogs(*, page=1):
     return {
         '__template__': 'manage_blogs.html',
         'page_index': get_page_index(page)
@@ -140,32 +163,43 @@ def manage_edit_blog(*, id):
 
 @get('/blog/{id}')
 async def get_blog(id):
-    blog = await Blog.find(id)
-    comments = await Comment.findAll('blog_id=?', [id], orderBy='created_at desc')
+    blog = await Blog.load(id)
+    comments = await Comment.findAll('blog_id=?', [id], orderBy='created_at desc', compact=True)
     for c in comments:
-        c.html_content = text2html(c.content)
-    blog.html_content = www.markdown2.markdown(blog.content)
+        c.html_content = www.render.text2html(c.content)
+    blog.html_content = await www.render.blog_html(blog)
     return {
         '__template__': 'blog.html',
         'blog': blog,
         'comments': comments
     }
 
+@get('/manage/metrics')
+def manage_metrics():
+    return dict(pools=www.orm.pool_stats(), query_cache=www.orm.query_cache_stats(), markdown=www.render.cache_info().stats(),
+                logs=www.logs.stats(), session=www.session.stats(), page_cache=www.pagecache.stats())
+
+@get('/manage/queries')
+def manage_queries():
+    return {
+        '__template__': 'manage_queries.html'
+    }
+
 @get('/manage/users')
-def manage_users(*, page='1'):
+def manage_users(*, page=1):
     return {
         '__template__': 'manage_users.html',
         'page_index': get_page_index(page)
     }
 
 @get('/api/comments')
-async def api_comments(*, page='1'):
-    page_index = get_page_index(page)
-    num = await Comment.findNumber('count(id)')
-    p = Page(num, page_index)
-    if num == 0:
-        return dict(page=p, comments=())
-    comments = await Comment.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+async def api_comments(*, page=1, cursor=None):
+    if cursor is not None:
+        p, comments = await find_cursor_page(Comment, cursor)
+        return dict(page=p, comments=comments)
+    p = Page(None, get_page_index(page))
+    comments = p.trim(await Comment.findAll(orderBy='created_at desc', limit=(p.offset, p.limit)))
+    p.set_item_count(await Comment.findNumberCached('count(id)'))
     return dict(page=p, comments=comments)
 
 @post('/api/blogs/{id}/comments')
@@ -181,8 +215,14 @@ async def api_create_comment(id, request, *, content):
     comment = Comment(blog_id=blog.id, blog_name=blog.name, user_id=user.id, user_name=user.name,
                       user_image=user.image, content=content.strip())
     await comment.save()
+    www.pagecache.invalidate('blog:%s' % blog.id)
     return comment
 
+@get('/api/slow_queries')
+def api_slow_queries(request):
+    check_admin(request)
+    return www.orm.slow_queries()
+
 @post('/api/comments/delete/{id}')
 async def api_delete_comments(id, request):
     check_admin(request)
@@ -190,18 +230,19 @@ async def api_delete_comments(id, request):
     if c is None:
         raise APIResourceNotFoundError('Comment')
     await c.remove()
+    www.pagecache.invalidate('blog:%s' % c.blog_id)
     return dict(id=id)
 
 @get('/api/users')
-async def api_get_users(*, page='1'):
-    page_index = get_page_index(page)
-    num = await User.findNumber('count(id)')
-    p = Page(num, page_index)
-    if num == 0:
-        return dict(page=p, users=())
+async def api_get_users(*, page=1, cursor=None):
+    if cursor is not None:
+        p, users = await find_cursor_page(User, cursor)
+    else:
+        p = Page(None, get_page_index(page))
+        users = p.trim(await User.findAll(orderBy='created_at desc', limit=(p.offset, p.limit)))
+        p.set_item_count(await User.findNumberCached('count(id)'))
     #管理员用户显示最前面
     admin_users = await User.findAll('admin=?', [1])
-    users = await User.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
     need_remove_users = []
     for u in users:
         u.passwd = '******'
@@ -268,18 +309,18 @@ async def api_register_user(*, email, name, passwd):
     return r
 
 @get('/api/blogs')
-async def api_blogs(*, page='1'):
-    page_index = get_page_index(page)
-    num = await Blog.findNumber('count(id)')
-    p = Page(num, page_index)
-    if num == 0:
-        return dict(page=p, blogs=())
-    blogs = await Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+async def api_blogs(*, page=1, cursor=None):
+    if cursor is not None:
+        p, blogs = await find_cursor_page(Blog, cursor, columns='list')
+        return dict(page=p, blogs=blogs)
+    p = Page(None, get_page_index(page))
+    blogs = p.trim(await Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit), columns='list'))
+    p.set_item_count(await Blog.findNumberCached('count(id)'))
     return dict(page=p, blogs=blogs)
 
 @get('/api/blogs/{id}')
 async def api_get_blog(*, id):
-    blog = await Blog.find(id)
+    blog = await Blog.load(id)
     return blog
 
 @post('/api/blogs')
@@ -293,7 +334,10 @@ async def api_create_blog(request, *, name, summary, content):
         raise APIValuaError('content', 'content cannot be empty')
     blog = Blog(user_id=request.__user__.id, user_name=request.__user__.name, user_image=request.__user__.image
                 , name=name.strip(), summary=summary, content=content)
+    if configs['markdown']['persist']:
+        blog.html_content = await www.render.markdown_async(blog.content, wait=True)
     await blog.save()
+    www.pagecache.invalidate('index')
     return blog
 
 @post('/api/blogs/{id}')
@@ -309,7 +353,10 @@ async def api_update_blog(id, request, *, name, summary, content):
     blog.name = name.strip()
     blog.summary = summary.strip()
     blog.content = content.strip()
+    if configs['markdown']['persist']:
+        blog.html_content = await www.render.markdown_async(blog.content, wait=True)
     await blog.update()
+    www.pagecache.invalidate('index', 'blog:%s' % id)
     return blog
 
 @post('/api/blogs/{id}/delete')
@@ -317,4 +364,5 @@ async def api_delete_blog(request, *, id):
     check_admin(request)
     blog = await Blog.find(id)
     await blog.remove()
+    www.pagecache.invalidate('index', 'blog:%s' % id)
     return dict(id=id)
\ No newline at end of file
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Primary key generators.
+
+The legacy scheme is a 50 chars string: 15 digits of milliseconds + 32 hex uuid + '000'.
+The snowflake scheme is a time-sortable 64-bit integer:
+
+    | 41 bits milliseconds since EPOCH | 10 bits worker id | 12 bits sequence |
+
+Migration path from the legacy scheme:
+
+1. set configs.ids.scheme to 'snowflake': new rows get snowflake ids, as decimal strings,
+   in the existing varchar(50) columns, old and new ids live side by side;
+2. run remap_legacy_ids() to rewrite the remaining legacy ids of blogs and comments
+   (and the columns referencing them) to snowflake ids derived from their embedded timestamp.
+
+Converting the id columns to bigint is not supported: ids from urls arrive as str while the
+database would return int, so find_many()/Model.load() would not match them, and JSON would
+send them as numbers, which JavaScript cannot represent above 2**53. Keep them as decimal strings.
+
+User ids stay as they are: the stored password hash is sha1(id:password), so changing a user id
+would lock the user out.
+'''
+
+__author__ = 'wang shi wen'
+
+import time, uuid, logging, threading, contextlib
+
+EPOCH = 1420070400000 # 2015-01-01 00:00:00 UTC
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+def legacy_id():
+    return '%015d%s000' % (int(time.time()*1000), uuid.uuid4().hex)
+
+class Snowflake(object):
+    '''
+    Monotonic 64-bit id generator.
+
+    If the clock goes backwards, ids keep using the last timestamp (and borrow the next millisecond
+    when its sequence runs out) instead of waiting, so ids are strictly increasing in this process.
+    Drift beyond max_drift milliseconds raises RuntimeError, because after a restart the same worker
+    could then hand out ids which are already used.
+
+    >>> g = Snowflake(3)
+    >>> a, b = g.next(), g.next()
+    >>> a < b, Snowflake.worker_of(a)
+    (True, 3)
+    '''
+
+    def __init__(self, worker_id=0, max_drift=1000):
+        if worker_id < 0 or worker_id > MAX_WORKER_ID:
+            raise ValueError('worker_id must be between 0 and %s' % MAX_WORKER_ID)
+        self.worker_id = worker_id
+        self.max_drift = max_drift
+        self._last = -1
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def next(self):
+        with self._lock:
+            now = int(time.time() * 1000) - EPOCH
+            if now > self._last:
+                self._last = now
+                self._sequence = 0
+            else:
+                if self._last - now > self.max_drift:
+                    raise RuntimeError('clock moved backwards %s ms, refuse to generate id' % (self._last - now))
+                self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+                if self._sequence == 0:
+                    # 当前毫秒的序号用完，借用下一毫秒
+                    self._last = self._last + 1
+            return (self._last << (WORKER_BITS + SEQUENCE_BITS)) | (self.worker_id << SEQUENCE_BITS) | self._sequence
+
+    @staticmethod
+    def timestamp_of(id):
+        ' return the unix time (seconds) encoded in id. '
+        return ((int(id) >> (WORKER_BITS + SEQUENCE_BITS)) + EPOCH) / 1000.0
+
+    @staticmethod
+    def worker_of(id):
+        return (int(id) >> SEQUENCE_BITS) & MAX_WORKER_ID
+
+def from_legacy(old_id, sequence, worker_id=0):
+    '''
+    Make a snowflake id keeping the timestamp of a legacy id, sequence tells apart ids of the same millisecond.
+
+    >>> Snowflake.timestamp_of(from_legacy('001480000000123' + 'a' * 32 + '000', 0))
+    1480000000.123
+    '''
+    millis = int(old_id[:15]) - EPOCH
+    return (millis << (WORKER_BITS + SEQUENCE_BITS)) | (worker_id << SEQUENCE_BITS) | (sequence & MAX_SEQUENCE)
+
+_generator = None
+
+def init(scheme='legacy', worker_id=0):
+    ' select the id scheme used by next_id(). '
+    global _generator
+    if scheme == 'snowflake':
+        logging.info('use snowflake ids, worker id: %s' % worker_id)
+        _generator = Snowflake(worker_id)
+    elif scheme == 'legacy':
+        _generator = None
+    else:
+        raise ValueError('Invalid id scheme: %s' % scheme)
+
+def next_id():
+    if _generator is None:
+        return legacy_id()
+    # 在varchar主键的表中以十进制字符串保存
+    return str(_generator.next())
+
+async def remap_legacy_ids(worker_id=0, chunk_size=500):
+    '''
+    Rewrite legacy ids of blogs and comments (and comments.blog_id) to snowflake ids.
+    Each row is rewritten in its own transaction together with the rows referencing it.
+    worker_id must not be used by any running server.
+    '''
+    import www.orm
+    from www.models import Blog, Comment
+    # 被引用的表 -> 引用它的(表, 列)
+    references = {
+        Blog: [(Comment, 'blog_id')],
+        Comment: []
+    }
+    for model, refs in references.items():
+        n = 0
+        sequences = dict()
+        # 按id排序，同一毫秒的旧id相邻，用sequence区分
+        # 出错时关闭iter_all，马上归还读取用的连接
+        async with contextlib.aclosing(model.iter_all('length(`id`)=50', None, chunk_size, orderBy='`id`', columns=(), compact=True)) as rows:
+            async for row in rows:
+                millis = row.id[:15]
+                sequence = sequences.get(millis, 0)
+                sequences = {millis: sequence + 1}
+                new_id = str(from_legacy(row.id, sequence, worker_id))
+                async with www.orm.transaction():
+                    await www.orm.execute('update `%s` set `id`=? where `id`=?' % model.__table__, [new_id, row.id])
+                    for ref, column in refs:
+                        await www.orm.execute('update `%s` set `%s`=? where `%s`=?' % (ref.__table__, column, column), [new_id, row.id])
+                n = n + 1
+        logging.info('remapped %s ids of %s' % (n, model.__table__))
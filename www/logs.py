@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Logging setup: records are put on a bounded queue and written by a background thread,
+as JSON lines (or plain text) configured by configs.logging.
+
+High volume logs go through a category logger, which samples before anything is formatted:
+
+    _log = www.logs.get_logger('sql')
+    _log.info('SQL: %s', sql, rows=len(rs))
+
+The message is only formatted, in the writer thread, if the record is sampled.
+Arguments are formatted later, so do not pass objects which are modified afterwards.
+'''
+
+__author__ = 'wang shi wen'
+
+import logging, logging.handlers, json, queue, random, sys, atexit
+
+class JsonFormatter(logging.Formatter):
+    '''
+    Format a record as one JSON object per line, fields given to a category logger become keys.
+    '''
+
+    def format(self, record):
+        d = dict(time=round(record.created, 3), level=record.levelname, logger=record.name, message=record.getMessage())
+        fields = getattr(record, 'fields', None)
+        if fields:
+            d.update(fields)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            d['exc'] = record.exc_text
+        return json.dumps(d, ensure_ascii=False, default=str)
+
+class TextFormatter(logging.Formatter):
+
+    def format(self, record):
+        s = super().format(record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            s = '%s %s' % (s, ' '.join('%s=%s' % (k, v) for k, v in fields.items()))
+        return s
+
+class QueueHandler(logging.handlers.QueueHandler):
+    '''
+    Put records on the queue without formatting them, drop them if the queue is full.
+    '''
+
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # traceback要在当前线程格式化，其他部分交给写日志的线程
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped = self.dropped + 1
+
+class CategoryLogger(object):
+    '''
+    Logger of a category (sql, request, handler...) which keeps only a sampled fraction of its records.
+    '''
+
+    def __init__(self, name, rate=1.0):
+        self.name = name
+        self.rate = rate
+        self.logger = logging.getLogger('awesome.%s' % name)
+
+    def enabled(self, level=logging.INFO):
+        ' check level and sampling, call before building expensive arguments, then log with emit(). '
+        rate = self.rate
+        if rate <= 0 or not self.logger.isEnabledFor(level):
+            return False
+        return rate >= 1 or random.random() < rate
+
+    def emit(self, level, msg, *args, **fields):
+        # 不再采样，调用者已经用enabled()判断过
+        self.logger.log(level, msg, *args, extra=dict(fields=fields))
+
+    def log(self, level, msg, *args, **fields):
+        if self.enabled(level):
+            self.emit(level, msg, *args, **fields)
+
+    def debug(self, msg, *args, **fields):
+        self.log(logging.DEBUG, msg, *args, **fields)
+
+    def info(self, msg, *args, **fields):
+        self.log(logging.INFO, msg, *args, **fields)
+
+    def warning(self, msg, *args, **fields):
+        # 警告不采样
+        if self.logger.isEnabledFor(logging.WARNING):
+            self.logger.warning(msg, *args, extra=dict(fields=fields))
+
+_categories = dict()
+_sample = dict()
+_handler = None
+_listener = None
+
+def get_logger(name):
+    logger = _categories.get(name)
+    if logger is None:
+        logger = CategoryLogger(name, _sample.get(name, 1.0))
+        _categories[name] = logger
+    return logger
+
+def setup(config):
+    '''
+    Replace the handlers of the root logger by a queue handler, and start the thread writing the records.
+    '''
+    global _handler, _listener
+    shutdown()
+    _sample.clear()
+    _sample.update(config.get('sample', None) or dict())
+    for name, logger in _categories.items():
+        logger.rate = _sample.get(name, 1.0)
+    filename = config.get('file', None)
+    target = logging.FileHandler(filename, encoding='utf-8') if filename else logging.StreamHandler(sys.stderr)
+    if config.get('format', 'json') == 'json':
+        target.setFormatter(JsonFormatter())
+    else:
+        target.setFormatter(TextFormatter('%(asctime)s %(levelname)s %(name)s %(message)s'))
+    _handler = QueueHandler(queue.Queue(config.get('queue_size', 10000)))
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.addHandler(_handler)
+    root.setLevel(config.get('level', 'INFO'))
+    _listener = logging.handlers.QueueListener(_handler.queue, target)
+    _listener.start()
+
+def shutdown():
+    ' flush the queue and stop the writer thread. '
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for h in _listener.handlers:
+            h.close()
+        _listener = None
+
+def stats():
+    return dict(dropped=_handler.dropped if _handler else 0, queued=_handler.queue.qsize() if _handler else 0,
+                sample=dict((name, logger.rate) for name, logger in _categories.items()))
+
+atexit.register(shutdown)
@@ -2,15 +2,20 @@ __author__ = 'Wang shi wen'
 
 #!/usr/bin/env python3
 
-import time, uuid
-from www.orm import Model, StringField, BooleanField, FloatField, TextField, create_pool
+import time
+from www.orm import Model, StringField, BooleanField, IntegerField, FloatField, TextField, create_pool, VERSIONS_TABLE
+from www.ids import next_id
+import www.ids
+import www.session
+from conf.config import configs
 
-def next_id():
-    return '%015d%s000' % (int(time.time()*1000), uuid.uuid4().hex)
+www.ids.init(configs['ids']['scheme'], configs['ids']['worker_id'])
 
 #用户
 class User(Model):
     __table__ = 'users'
+    __unique__ = [('email',)]
+    __indexes__ = [('admin',), ('created_at',)]
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     email = StringField(ddl='varchar(50)')
@@ -20,9 +25,25 @@ class User(Model):
     image = StringField(ddl='varchar(500)')
     created_at = FloatField(default=time.time)
 
+    async def update(self):
+        dirty = self.__dirty__
+        await super().update()
+        # 密码或管理员权限变化后，缓存的登录状态失效
+        if dirty is None or 'passwd' in dirty or 'admin' in dirty:
+            www.session.invalidate(self.id)
+
+    async def remove(self):
+        await super().remove()
+        www.session.invalidate(self.id)
+
 #博客
 class Blog(Model):
     __table__ = 'blogs'
+    __indexes__ = [('created_at',)]
+    # 列表页不需要content
+    __views__ = {
+        'list': ('user_id', 'user_name', 'user_image', 'name', 'summary', 'created_at')
+    }
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     user_id = StringField(ddl='varchar(50)')
@@ -32,10 +53,14 @@ class Blog(Model):
     summary = StringField(ddl='varchar(200)')
     content = TextField()
     created_at = FloatField(default=time.time)
+    # 持久化的markdown渲染结果，由api_create_blog/api_update_blog写入
+    if configs['markdown']['persist']:
+        html_content = TextField()
 
 #评论
 class Comment(Model):
     __table__ = 'comments'
+    __indexes__ = [('blog_id', 'created_at'), ('created_at',)]
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     blog_id = StringField(ddl='varchar(50)')
@@ -46,3 +71,10 @@ class Comment(Model):
     content = TextField()
     created_at = FloatField(default=time.time)
 
+#表的版本号，所有进程共享，用于ETag，由orm在写操作后更新
+class TableVersion(Model):
+    __table__ = VERSIONS_TABLE
+
+    table_name = StringField(primary_key=True, ddl='varchar(50)')
+    version = IntegerField()
+    updated_at = FloatField(default=time.time)
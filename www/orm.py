@@ -2,64 +2,740 @@ __author__ = 'Wang shi wen'
 
 #!/usr/bin/env python3
 
-import asyncio, logging
-import aiomysql
+import asyncio, logging, time, contextvars, re, os, sys, functools, collections, contextlib, random
+from collections import OrderedDict
 
-def log(sql, args=()):
-    logging.info('SQL: %s' % sql)
+from www.backends import get_backend
+import www.logs
+
+_sql_log = www.logs.get_logger('sql')
+
+def log(sql, args=(), pool=None, rows=None, duration=None):
+    # 按configs.logging.sample.sql采样，没有采到时不做任何格式化
+    if _sql_log.enabled():
+        _sql_log.emit(logging.INFO, 'SQL: %s', sql, args=len(args or ()), pool=pool, rows=rows,
+                      duration=None if duration is None else round(duration * 1000, 3))
+
+class QueryCache(object):
+    '''
+    LRU cache of select results with ttl and an approximate memory cap.
+    Keys contain the version of every table the query reads, so bumping a table version invalidates its entries.
+    '''
+
+    def __init__(self, ttl=30, max_entries=1000, max_bytes=16 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key -> (rs, expires, size)
+        self._data = OrderedDict()
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None or entry[1] < time.time():
+            if entry is not None:
+                self._evict(key)
+            self.misses = self.misses + 1
+            return None
+        self._data.move_to_end(key)
+        self.hits = self.hits + 1
+        return entry[0]
+
+    def put(self, key, rs):
+        size = _sizeof(rs)
+        if size > self.max_bytes:
+            return
+        if key in self._data:
+            self._evict(key)
+        self._data[key] = (rs, time.time() + self.ttl, size)
+        self.bytes = self.bytes + size
+        while len(self._data) > self.max_entries or self.bytes > self.max_bytes:
+            self._evict(next(iter(self._data)))
+
+    def _evict(self, key):
+        rs, expires, size = self._data.pop(key)
+        self.bytes = self.bytes - size
+        self.evictions = self.evictions + 1
+
+    def clear(self):
+        self._data.clear()
+        self.bytes = 0
+
+    def stats(self):
+        return dict(entries=len(self._data), bytes=self.bytes, hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+def _sizeof(rs):
+    # 估算结果集占用的内存: list + 每行 + 每个值
+    size = sys.getsizeof(rs)
+    for r in rs:
+        size = size + sys.getsizeof(r)
+        for v in (r.values() if isinstance(r, dict) else r):
+            size = size + sys.getsizeof(v)
+    return size
+
+# 每个表的版本号，写操作后加一
+_table_versions = dict()
+# 查询结果缓存，create_pool时根据query_cache配置创建，None表示不启用
+_query_cache = None
+
+_RE_READ_TABLES = re.compile(r'\b(?:from|join)\s+`?(\w+)`?', re.IGNORECASE)
+_RE_WRITE_TABLE = re.compile(r'^\s*(?:insert\s+into|replace\s+into|update|delete\s+from)\s+`?(\w+)`?', re.IGNORECASE)
+
+@functools.lru_cache(maxsize=1024)
+def read_tables(sql):
+    return tuple(sorted(set(_RE_READ_TABLES.findall(sql))))
+
+@functools.lru_cache(maxsize=1024)
+def write_table(sql):
+    m = _RE_WRITE_TABLE.match(sql)
+    return m.group(1) if m else None
+
+def bump_table(table):
+    ' invalidate cached results of table. '
+    _table_versions[table] = _table_versions.get(table, 0) + 1
+    _table_modified[table] = time.time()
+
+# 表最后一次在本进程中写入的时间，没有写过的表按进程启动时间算
+_started_at = time.time()
+_table_modified = dict()
+# 当前请求(task)读过的表，由track_reads()开启
+_reads = contextvars.ContextVar('reads', default=None)
+
+def track_reads():
+    ' start collecting the tables read in the current task, returns the set filled by select(). '
+    tables = set()
+    _reads.set(tables)
+    return tables
+
+def _track(tables):
+    reads = _reads.get()
+    if reads is not None:
+        reads.update(tables)
+
+# 所有进程共享的表版本号，保存在table_versions表中，由create_pool按db.table_versions开启
+VERSIONS_TABLE = 'table_versions'
+_shared_versions = False
+
+async def _bump_shared(table):
+    # 写操作(或事务提交)完成后再加一，先读版本号再读数据的请求不会把旧数据当成新版本
+    if not _shared_versions or table == VERSIONS_TABLE:
+        return
+    now = time.time()
+    update = 'update `%s` set `version`=`version`+1, `updated_at`=? where `table_name`=?' % VERSIONS_TABLE
+    try:
+        if await _execute(update, (now, table), True) == 0:
+            try:
+                await _execute('insert into `%s` (`table_name`, `version`, `updated_at`) values (?, ?, ?)' % VERSIONS_TABLE, (table, 1, now), True)
+            except Exception:
+                # 其他进程同时插入了这一行
+                await _execute(update, (now, table), True)
+    except Exception as e:
+        logging.warning('bump version of table %s failed: %s' % (table, e))
+
+async def table_versions():
+    '''
+    Return {table: (version, updated_at)} shared by all processes, or None if not enabled.
+    Read it before the data of a request, and pass it to tables_version().
+    '''
+    if not _shared_versions:
+        return None
+    try:
+        rs = await select('select `table_name`, `version`, `updated_at` from `%s`' % VERSIONS_TABLE, (), tuples=True, cache=False)
+    except Exception as e:
+        logging.warning('read table versions failed: %s' % e)
+        return None
+    return dict((r[0], (r[1], r[2])) for r in rs)
+
+def tables_version(tables, versions=None):
+    '''
+    Return (token, last modified time) of tables, for ETag and Last-Modified.
+    With versions from table_versions() the token is the same in all processes and changes with
+    every write made through the orm. Without it, the token changes with every write to these
+    tables made by this process, and after a restart.
+    '''
+    tables = sorted(tables)
+    if versions is not None:
+        token = ','.join('%s=%s' % (t, versions.get(t, (0, 0))[0]) for t in tables)
+        modified = max([versions.get(t, (0, 0))[1] for t in tables] or [0])
+        return token, modified
+    token = '%s:%s:%s' % (os.getpid(), _started_at, ','.join('%s=%s' % (t, _table_versions.get(t, 0)) for t in tables))
+    modified = max([_table_modified.get(t, _started_at) for t in tables] or [_started_at])
+    return token, modified
+
+def query_cache_stats():
+    if _query_cache is None:
+        return None
+    return _query_cache.stats()
+
+# 只读副本的连接池，select按_replica_policy在其中选择，execute总是使用主库__pool
+_replica_pools = []
+_replica_policy = 'round_robin'
+_replica_index = 0
+# 读写一致: 写过数据的请求(task)或用户在_sticky_seconds内继续读主库
+_sticky_seconds = 5
+_sticky_key = contextvars.ContextVar('sticky_key', default=None)
+_sticky_task_until = contextvars.ContextVar('sticky_task_until', default=0)
+_sticky_until = dict()
+
+class PoolStats(object):
+    '''
+    Counters of one connection pool: acquire wait, timeouts and query duration, times in seconds.
+    '''
+
+    def __init__(self):
+        self.acquires = 0
+        self.acquire_timeouts = 0
+        self.acquire_wait_total = 0.0
+        self.acquire_wait_max = 0.0
+        self.queries = 0
+        self.query_errors = 0
+        self.query_time_total = 0.0
+        self.query_time_max = 0.0
+
+    def record_acquire(self, wait):
+        self.acquires = self.acquires + 1
+        self.acquire_wait_total = self.acquire_wait_total + wait
+        if wait > self.acquire_wait_max:
+            self.acquire_wait_max = wait
+
+    def record_query(self, duration, error=False):
+        self.queries = self.queries + 1
+        if error:
+            self.query_errors = self.query_errors + 1
+        self.query_time_total = self.query_time_total + duration
+        if duration > self.query_time_max:
+            self.query_time_max = duration
+
+    def to_dict(self):
+        d = dict(self.__dict__)
+        d['acquire_wait_avg'] = self.acquire_wait_total / self.acquires if self.acquires else 0.0
+        d['query_time_avg'] = self.query_time_total / self.queries if self.queries else 0.0
+        return d
+
+class DbPool(object):
+    '''
+    Wrap a driver pool (see www.backends): limit the connections in use to an adjustable limit,
+    and record acquire wait time, timeouts and query duration in stats.
+    '''
+
+    def __init__(self, name, pool, limit, acquire_timeout=None, backend=None):
+        self.name = name
+        self.pool = pool
+        self.backend = backend
+        self.limit = limit
+        self.acquire_timeout = acquire_timeout
+        self.in_use = 0
+        self.stats = PoolStats()
+        self._waiters = collections.deque()
+
+    @property
+    def idle(self):
+        return self.pool.freesize
+
+    @property
+    def size(self):
+        return self.pool.size
+
+    async def acquire(self):
+        t = time.time()
+        try:
+            conn = await asyncio.wait_for(self._acquire(), self.acquire_timeout)
+        except asyncio.TimeoutError:
+            self.stats.acquire_timeouts = self.stats.acquire_timeouts + 1
+            logging.warning('acquire connection timeout: pool %s, in use %s/%s' % (self.name, self.in_use, self.limit))
+            raise
+        self.stats.record_acquire(time.time() - t)
+        return conn
+
+    async def _acquire(self):
+        if self.in_use < self.limit and not self._waiters:
+            self.in_use = self.in_use + 1
+        else:
+            fut = asyncio.get_event_loop().create_future()
+            self._waiters.append(fut)
+            try:
+                await fut
+            except asyncio.CancelledError:
+                if fut.done() and not fut.cancelled():
+                    # 已经分到名额后才被取消，把名额还回去
+                    self._release_slot()
+                else:
+                    self._waiters.remove(fut)
+                raise
+        try:
+            return await self.pool.acquire()
+        except BaseException:
+            self._release_slot()
+            raise
+
+    def release(self, conn):
+        self.pool.release(conn)
+        self._release_slot()
+
+    def _release_slot(self):
+        self.in_use = self.in_use - 1
+        self._wake()
+
+    def _wake(self):
+        while self._waiters and self.in_use < self.limit:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                self.in_use = self.in_use + 1
+                fut.set_result(None)
+
+    def set_limit(self, limit):
+        logging.info('pool %s: limit %s => %s' % (self.name, self.limit, limit))
+        self.limit = limit
+        self._wake()
+
+    @contextlib.asynccontextmanager
+    async def get(self):
+        conn = await self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def to_dict(self):
+        d = self.stats.to_dict()
+        d.update(name=self.name, limit=self.limit, in_use=self.in_use, idle=self.idle, size=self.size, waiting=len(self._waiters))
+        return d
+
+async def adapt_pool(pool, min_limit, max_limit, interval=5, grow_wait=0.05, shrink_wait=0.005):
+    '''
+    Grow the limit of pool when the average acquire wait of the last interval is above grow_wait seconds,
+    shrink it when the wait is below shrink_wait and less than half of the connections are in use.
+    '''
+    acquires = pool.stats.acquires
+    wait_total = pool.stats.acquire_wait_total
+    timeouts = pool.stats.acquire_timeouts
+    while True:
+        await asyncio.sleep(interval)
+        n = pool.stats.acquires - acquires
+        wait = (pool.stats.acquire_wait_total - wait_total) / n if n else 0.0
+        timeout = pool.stats.acquire_timeouts > timeouts
+        acquires = pool.stats.acquires
+        wait_total = pool.stats.acquire_wait_total
+        timeouts = pool.stats.acquire_timeouts
+        if (wait > grow_wait or timeout) and pool.limit < max_limit:
+            pool.set_limit(min(max_limit, pool.limit * 2))
+        elif wait < shrink_wait and pool.in_use * 2 < pool.limit and pool.limit > min_limit:
+            pool.set_limit(max(min_limit, pool.limit - 1))
+            if pool.idle > pool.limit:
+                # 关闭空闲连接，之后按需重新创建
+                await pool.pool.clear()
+
+def pool_stats():
+    ' return stats of the primary and replica pools. '
+    return [p.to_dict() for p in [__pool] + _replica_pools]
 
 async def create_pool(loop, **kw):
     logging.info('create database connection pool...')
-    global __pool
-    __pool = await aiomysql.create_pool(
-        host=kw.get('host', 'localhost'),
-        port=kw.get('port', 3306),
-        user=kw.get('user'),
-        password=kw.get('password'),
-        db=kw.get('database'),
-        charset=kw.get('charset', 'utf8'),
-        autocommit=kw.get('autocommit', True),
-        maxsize=kw.get('maxsize', 10),
-        minsize=kw.get('minsize', 1),
-        loop=loop
-    )
+    global __pool, _query_cache, _replica_pools, _replica_policy, _sticky_seconds, _slow_threshold, _explain_sample, _slow_queries, _shared_versions
+    slow_config = kw.get('slow_query', None) or dict()
+    _slow_threshold = slow_config.get('threshold', 0.1)
+    _explain_sample = slow_config.get('explain_sample', 0.1)
+    _slow_queries = collections.deque(maxlen=slow_config.get('buffer_size', 200))
+    cache_config = kw.get('query_cache', None)
+    if cache_config and cache_config.get('enabled', True):
+        logging.info('enable query cache: %s' % str(cache_config))
+        _query_cache = QueryCache(cache_config.get('ttl', 30), cache_config.get('max_entries', 1000), cache_config.get('max_bytes', 16 * 1024 * 1024))
+    __pool = await _create_pool(loop, 'primary', kw)
+    # 副本的配置没有写的项沿用主库的配置
+    replicas = []
+    for i, replica in enumerate(kw.get('replicas', None) or []):
+        rkw = dict(kw)
+        rkw.update(replica)
+        logging.info('create replica connection pool: %s:%s' % (rkw.get('host'), rkw.get('port', 3306)))
+        replicas.append(await _create_pool(loop, 'replica%s' % i, rkw))
+    _replica_pools = replicas
+    _replica_policy = kw.get('replica_policy', 'round_robin')
+    _sticky_seconds = kw.get('sticky_seconds', 5)
+    _shared_versions = kw.get('table_versions', False)
+
+def set_sticky_key(key):
+    ' set the key (e.g. user id) used to keep reads on the primary after this key wrote. '
+    _sticky_key.set(key)
+
+def _mark_write():
+    if not _replica_pools:
+        return
+    until = time.time() + _sticky_seconds
+    _sticky_task_until.set(until)
+    key = _sticky_key.get()
+    if key is not None:
+        if len(_sticky_until) > 10000:
+            now = time.time()
+            for k in [k for k, t in _sticky_until.items() if t < now]:
+                del _sticky_until[k]
+        _sticky_until[key] = until
+
+def _is_sticky():
+    # 当前请求(task)或用户刚写过数据，要读主库
+    now = time.time()
+    if _sticky_task_until.get() > now:
+        return True
+    key = _sticky_key.get()
+    return key is not None and _sticky_until.get(key, 0) > now
+
+def _read_pool():
+    global _replica_index
+    if not _replica_pools or _is_sticky():
+        return __pool
+    if _replica_policy == 'least_busy':
+        # 正在使用的连接最少的副本
+        return min(_replica_pools, key=lambda p: p.in_use)
+    _replica_index = (_replica_index + 1) % len(_replica_pools)
+    return _replica_pools[_replica_index]
+
+async def _create_pool(loop, name, kw):
+    maxsize = kw.get('maxsize', 10)
+    adaptive = kw.get('adaptive', None)
+    if adaptive and adaptive.get('enabled', True):
+        # 自适应时连接池按上限创建，实际使用的连接数由DbPool.limit控制
+        poolsize = max(maxsize, adaptive.get('max', maxsize))
+    else:
+        adaptive = None
+        poolsize = maxsize
+    backend = get_backend(kw.get('engine', 'mysql'))
+    pool = await backend.create_pool(loop, kw, poolsize)
+    pool = DbPool(name, pool, min(maxsize, pool.maxsize), kw.get('acquire_timeout', None), backend)
+    if adaptive:
+        loop.create_task(adapt_pool(pool, adaptive.get('min', 1), poolsize, adaptive.get('interval', 5),
+                                    adaptive.get('grow_wait', 0.05), adaptive.get('shrink_wait', 0.005)))
+    return pool
+
+# 慢查询记录: 超过_slow_threshold秒的语句记录在环形缓冲区中，按_explain_sample的比例抓取EXPLAIN
+_slow_threshold = 0.1
+_explain_sample = 0.1
+_slow_queries = collections.deque(maxlen=200)
+
+def _args_shape(args):
+    # 只记录参数的个数和类型，不记录值
+    return [type(a).__name__ for a in (args or ())]
+
+def _record_slow(pool, sql, args, rows, duration):
+    record = dict(created_at=time.time(), pool=pool.name, sql=sql, args=_args_shape(args),
+                  rows=rows, duration=round(duration * 1000, 3), explain=None)
+    _slow_queries.append(record)
+    logging.warning('slow query: %.1f ms, rows: %s, sql: %s' % (duration * 1000, rows, sql))
+    if _explain_sample > 0 and random.random() < _explain_sample and _RE_EXPLAINABLE.match(sql):
+        asyncio.ensure_future(_explain(pool, record, sql, args))
+
+_RE_EXPLAINABLE = re.compile(r'^\s*(select|update|delete|insert|replace)\b', re.IGNORECASE)
+
+async def _explain(pool, record, sql, args):
+    # 直接从连接池取连接，不经过select()，避免进入事务、缓存和慢查询统计
+    try:
+        async with pool.get() as conn:
+            record['explain'] = list(await pool.backend.fetch(conn, pool.backend.explain_sql(sql), args))
+    except Exception as e:
+        logging.warning('explain failed: %s' % e)
+
+def slow_queries():
+    ' return the threshold (seconds) and the recorded slow queries, newest first. '
+    return dict(threshold=_slow_threshold, queries=list(reversed(_slow_queries)))
 
 # 封装SQL SELECT语句为select函数
-async def select(sql, args, size=None):
-    log(sql, args)
-    global __pool
-    async with __pool.get() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cur:
-            # 执行SQL语句
-            # SQL语句的占位符为?，MySQL的占位符为%s
-            await cur.execute(sql.replace('?', '%s'), args or ())
-            if size:
-                rs = await cur.fetchmany(size)
-            else:
-                rs = await cur.fetchall()
-            logging.info('rows returned: %s', len(rs))
+# tuples=True时返回普通tuple，省去DictCursor为每行构造的dict，由调用者按列顺序解码
+# 启用查询缓存时，cache=False可以跳过缓存
+async def select(sql, args, size=None, tuples=False, cache=True):
+    _track(read_tables(sql))
+    key = None
+    # 事务中可能读到未提交的数据，不使用缓存
+    if cache and _query_cache is not None and _transaction.get() is None:
+        key = (sql, tuple(args or ()), size, tuples, tuple(_table_versions.get(t, 0) for t in read_tables(sql)))
+        rs = _query_cache.get(key)
+        if rs is not None:
             return rs
+    rs = await _select(sql, args, size, tuples)
+    if key is not None:
+        _query_cache.put(key, rs)
+    return rs
+
+async def _select(sql, args, size, tuples):
+    tx = _transaction.get()
+    if tx is not None:
+        async with tx.lock:
+            return await _fetch(tx.pool, tx.conn, sql, args, size, tuples)
+    pool = _read_pool()
+    async with pool.get() as conn:
+        return await _fetch(pool, conn, sql, args, size, tuples)
+
+async def _fetch(pool, conn, sql, args, size, tuples):
+    t = time.time()
+    error = True
+    try:
+        # 执行SQL语句，占位符?由驱动转换
+        rs = await pool.backend.fetch(conn, sql, args, size, tuples)
+        error = False
+    finally:
+        duration = time.time() - t
+        pool.stats.record_query(duration, error)
+    if duration >= _slow_threshold:
+        _record_slow(pool, sql, args, len(rs), duration)
+    log(sql, args, pool.name, len(rs), duration)
+    return rs
+
+# 流式读取大结果集，每次fetchmany一个chunk(MySQL使用无缓冲的服务端游标SSCursor)
+# 整个迭代过程中占用一个连接池的连接(不使用transaction()固定的连接)
+async def select_iter(sql, args, chunk_size=500):
+    log(sql, args)
+    _track(read_tables(sql))
+    pool = _read_pool()
+    conn = await pool.acquire()
+    done = False
+    chunks = None
+    try:
+        t = time.time()
+        chunks = pool.backend.iter_chunks(conn, sql, args, chunk_size)
+        first = True
+        async for rs in chunks:
+            if first:
+                pool.stats.record_query(time.time() - t)
+                first = False
+            yield rs
+        done = True
+    finally:
+        if not done:
+            # 被取消或提前退出时结果集还没读完，连接已经不能再用，直接关闭再还给连接池
+            logging.warning('select_iter aborted, close connection.')
+            if chunks is not None:
+                # 先结束驱动的迭代器，它的finally还要用到这个连接
+                try:
+                    await chunks.aclose()
+                except Exception as e:
+                    logging.warning('close select_iter cursor failed: %s' % e)
+            pool.backend.discard(conn)
+        pool.release(conn)
 
 # 封装INSERT, UPDATE, DELETE
 # 语句操作参数一样，所以定义一个通用的执行函数
 # 返回操作影响的行号
+# 在transaction()中执行时使用事务固定的连接，autocommit参数无效
 async def execute(sql, args, autocommit=True):
-    log(sql)
-    async with __pool.get() as conn:
+    table = write_table(sql)
+    if table is not None:
+        bump_table(table)
+    _mark_write()
+    tx = _transaction.get()
+    if tx is not None:
+        if table is not None:
+            # 提交时再让这些表的缓存失效
+            tx.tables.add(table)
+        async with tx.lock:
+            return await _run(tx.pool, tx.conn, sql, args)
+    try:
+        affected = await _execute(sql, args, autocommit)
+    finally:
+        # 执行期间并发的select可能缓存了旧数据，完成后再加一次版本号
+        if table is not None:
+            bump_table(table)
+    if table is not None:
+        await _bump_shared(table)
+    return affected
+
+async def _execute(sql, args, autocommit):
+    pool = __pool
+    async with pool.get() as conn:
         if not autocommit:
-            conn.begin()
+            await pool.backend.begin(conn)
         try:
-            async with conn.cursor(aiomysql.DictCursor) as cur:
-                await cur.execute(sql.replace('?', '%s'), args)
-                affected = cur.rowcount
+            affected = await _run(pool, conn, sql, args)
             if not autocommit:
-                await conn.commit()
+                await pool.backend.commit(conn)
         except BaseException as e:
             if not autocommit:
-                await conn.rollback()
+                await pool.backend.rollback(conn)
             raise
         return affected
 
+async def _run(pool, conn, sql, args):
+    t = time.time()
+    error = True
+    try:
+        affected = await pool.backend.run(conn, sql, args)
+        error = False
+    finally:
+        duration = time.time() - t
+        pool.stats.record_query(duration, error)
+    if duration >= _slow_threshold:
+        _record_slow(pool, sql, args, affected, duration)
+    log(sql, args, pool.name, affected, duration)
+    return affected
+
+# 当前task所在的事务，由transaction()设置
+_transaction = contextvars.ContextVar('transaction', default=None)
+
+def _primary():
+    return __pool
+
+class Transaction(object):
+    # 事务固定的连接，同一事务内的语句串行执行
+    def __init__(self, pool, conn):
+        self.pool = pool
+        self.conn = conn
+        self.lock = asyncio.Lock()
+        self.depth = 0
+        self.tables = set()
+
+class transaction(object):
+    '''
+    Run select/execute/Model methods in the block on one pinned connection and commit once at the end:
+
+        async with orm.transaction():
+            await comment.save()
+            await execute('update ...', args)
+
+    Nested blocks use savepoints, an exception rolls back only the innermost block.
+    '''
+
+    def __init__(self):
+        self._tx = None
+        self._token = None
+        self._savepoint = None
+
+    async def __aenter__(self):
+        tx = _transaction.get()
+        if tx is not None:
+            tx.depth = tx.depth + 1
+            self._tx = tx
+            self._savepoint = 'sp_%s' % tx.depth
+            async with tx.lock:
+                await _run(tx.pool, tx.conn, 'savepoint %s' % self._savepoint, ())
+            return tx
+        pool = _primary()
+        conn = await pool.acquire()
+        try:
+            await pool.backend.begin(conn)
+        except BaseException:
+            pool.release(conn)
+            raise
+        self._tx = Transaction(pool, conn)
+        self._token = _transaction.set(self._tx)
+        return self._tx
+
+    async def __aexit__(self, exc_type, exc, tb):
+        tx = self._tx
+        if self._savepoint is not None:
+            tx.depth = tx.depth - 1
+            async with tx.lock:
+                if exc_type is None:
+                    await _run(tx.pool, tx.conn, 'release savepoint %s' % self._savepoint, ())
+                else:
+                    await _run(tx.pool, tx.conn, 'rollback to savepoint %s' % self._savepoint, ())
+            return False
+        _transaction.reset(self._token)
+        try:
+            if exc_type is None:
+                await tx.pool.backend.commit(tx.conn)
+            else:
+                await tx.pool.backend.rollback(tx.conn)
+        finally:
+            tx.pool.release(tx.conn)
+            for table in tx.tables:
+                bump_table(table)
+        if exc_type is None:
+            for table in tx.tables:
+                await _bump_shared(table)
+        return False
+
+_RE_PREDICATE = re.compile(r'`?(\w+)`?\s*(?:=|<|>|!=|\bin\b|\blike\b|\bbetween\b|\bis\b)', re.IGNORECASE)
+# 已经检查过的(表, where)
+_checked_wheres = set()
+
+def check_indexed(model, where):
+    ' log a warning once for every column in where which is not the leading column of an index. '
+    key = (model.__table__, where)
+    if key in _checked_wheres:
+        return
+    _checked_wheres.add(key)
+    for column in _RE_PREDICATE.findall(where):
+        if column in model.__mappings__ and column not in model.__indexed__:
+            logging.warning('unindexed column in where: %s.%s (%s)' % (model.__table__, column, where))
+
+# findNumberCached的缓存
+_number_cache = dict()
+
+def _spawn(coro):
+    # 在空的context中创建task，调用者的事务、sticky key和读表记录不会带到后台task里
+    return contextvars.Context().run(asyncio.ensure_future, coro)
+
+class Loader(object):
+    '''
+    Coalesce Model.load() calls of one model issued in the same event loop tick into one find_many() query.
+    '''
+
+    def __init__(self, model):
+        self.model = model
+        # pk -> 等待该pk的future列表
+        self._pending = dict()
+        self._scheduled = False
+
+    def load(self, pk):
+        # 查询可能由别的请求发出，这里记下读过的表
+        _track((self.model.__table__,))
+        loop = asyncio.get_event_loop()
+        if _transaction.get() is not None or (_replica_pools and _is_sticky()):
+            # 事务中要用事务的连接读，刚写过数据的要读主库，都不和其他请求合并
+            return asyncio.ensure_future(self.model.find(pk))
+        fut = loop.create_future()
+        waiters = self._pending.get(pk)
+        if waiters is None:
+            self._pending[pk] = [fut]
+        else:
+            waiters.append(fut)
+        if not self._scheduled:
+            # 当前tick内的调用都收集完之后再发出查询
+            self._scheduled = True
+            loop.call_soon(self._dispatch, context=contextvars.Context())
+        return fut
+
+    def _dispatch(self):
+        pending = self._pending
+        self._pending = dict()
+        self._scheduled = False
+        _spawn(self._fetch(pending))
+
+    async def _fetch(self, pending):
+        try:
+            rs = await self.model.find_many(list(pending.keys()))
+        except Exception as e:
+            for waiters in pending.values():
+                for fut in waiters:
+                    if not fut.done():
+                        fut.set_exception(e)
+            return
+        for waiters, m in zip(pending.values(), rs):
+            for i, fut in enumerate(waiters):
+                if not fut.done():
+                    # 同一个pk的每个调用者拿到各自的实例，避免互相修改
+                    fut.set_result(m if (m is None or i == 0) else m._fromRow(m, m.__unloaded__))
+
+# Loader的作用域: 默认整个应用共用一组Loader，调用loader_scope()后当前请求(task)使用自己的一组
+_app_loaders = dict()
+_loaders = contextvars.ContextVar('loaders', default=None)
+
+def loader_scope():
+    ' start a new loader scope for the current task, e.g. at the beginning of a request. '
+    _loaders.set(dict())
+
+def get_loader(model):
+    loaders = _loaders.get()
+    if loaders is None:
+        loaders = _app_loaders
+    loader = loaders.get(model)
+    if loader is None:
+        loader = Loader(model)
+        loaders[model] = loader
+    return loader
+
+class FieldNotLoadedError(AttributeError):
+    # 访问或保存投影查询(columns=)中没有加载的字段
+    pass
 
 class Field(object):
     # 表的字段包含名字、类型、是否为表的主键和默认值
@@ -95,6 +771,79 @@ class TextField(Field):
     def __init__(self, name=None, default=None):
         super().__init__(name, 'text', False, default)
 
+# 紧凑模式(findAll(compact=True))使用的行对象
+# 每个Model由ModelMetaclass生成一个Row的子类，每列一个slot，不再是一个dict
+class Row(object):
+    __slots__ = ('_extra',)
+    __columns__ = ()
+    __model__ = None
+
+    @classmethod
+    def _fromDict(cls, r):
+        row = cls.__new__(cls)
+        setter = object.__setattr__
+        setter(row, '_extra', None)
+        for k, v in r.items():
+            setter(row, k, v)
+        return row
+
+    @classmethod
+    def _fromTuple(cls, names, values):
+        row = cls.__new__(cls)
+        setter = object.__setattr__
+        setter(row, '_extra', None)
+        for k, v in zip(names, values):
+            setter(row, k, v)
+        return row
+
+    def __getattr__(self, item):
+        # 只有slot没有赋值或者不是列的属性才会走到这里
+        if item == '_extra':
+            raise AttributeError(item)
+        extra = self._extra
+        if extra is not None and item in extra:
+            return extra[item]
+        if item in self.__columns__:
+            raise FieldNotLoadedError(r"'%s' row is partially loaded, field '%s' was not selected" % (self.__model__.__name__, item))
+        raise AttributeError(r"'%s' object has no attribute '%s'" % (self.__class__.__name__, item))
+
+    def __setattr__(self, key, value):
+        if key in self.__columns__:
+            object.__setattr__(self, key, value)
+            return
+        # 非列的属性(例如html_content)放在_extra里
+        if self._extra is None:
+            object.__setattr__(self, '_extra', dict())
+        self._extra[key] = value
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def keys(self):
+        L = [k for k in self.__columns__ if hasattr(self, k)]
+        if self._extra:
+            L.extend(self._extra.keys())
+        return L
+
+    def _asdict(self):
+        return dict((k, getattr(self, k)) for k in self.keys())
+
+    def toModel(self):
+        ' convert to a full Model instance, e.g. to update() it. '
+        return self.__model__(**self._asdict())
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join('%s=%r' % (k, getattr(self, k)) for k in self.keys()))
+
 # 根据输入的参数生成占位符列表
 def create_args_string(num):
     L = []
@@ -125,6 +874,8 @@ class ModelMetaclass(type):
         if name == 'Model':
             return type.__new__(cls, name, bases, attrs)
 
+        # 子类也不要实例的__dict__，每行只有dict本身和Model的两个slot
+        attrs.setdefault('__slots__', ())
         # 获取table名称:
         tableName = attrs.get('__table__', None) or name
         logging.info('found model:%s (table:%s)'% (name, tableName))
@@ -161,6 +912,8 @@ class ModelMetaclass(type):
         attrs['__primary_key__'] = primaryKey
         # 保存除主键外的属性名
         attrs['__fields__'] = fields
+        # __select__中列的顺序，用于解码tuple行
+        attrs['__columns__'] = tuple([primaryKey] + fields)
         # 构造默认的SELECT, INSERT, UPDATE和DELETE语句:
         # ``反引号功能同repr()
         attrs['__select__'] = 'select `%s`, %s from `%s`' % (primaryKey, ', '.join(escaped_fields), tableName)
@@ -169,17 +922,60 @@ class ModelMetaclass(type):
         attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (
         tableName, ', '.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primaryKey)
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (tableName, primaryKey)
-        return type.__new__(cls, name, bases, attrs)
+        # 检查__views__中声明的列，投影查询的SELECT语句按列缓存在__selects__中
+        for view, columns in attrs.get('__views__', {}).items():
+            for c in columns:
+                if c not in mappings:
+                    raise RuntimeError('Unknown column %s in view %s of %s' % (c, view, name))
+        # 声明的索引，例如 __indexes__ = [('blog_id', 'created_at')]，__unique__中的是唯一索引
+        indexes = [tuple(i) for i in attrs.get('__indexes__', ())]
+        uniques = [tuple(i) for i in attrs.get('__unique__', ())]
+        for index in indexes + uniques:
+            for c in index:
+                if c not in mappings:
+                    raise RuntimeError('Unknown column %s in index of %s' % (c, name))
+        attrs['__indexes__'] = indexes
+        attrs['__unique__'] = uniques
+        # 可以用索引查找的列: 主键和每个索引的第一列
+        attrs['__indexed__'] = frozenset([primaryKey] + [i[0] for i in indexes + uniques])
+        attrs['__selects__'] = dict()
+        # 只更新部分字段的UPDATE语句，按字段集合缓存
+        attrs['__updates__'] = dict()
+        model = type.__new__(cls, name, bases, attrs)
+        # 生成紧凑模式的行类，每列一个slot
+        columns = attrs['__columns__']
+        model.__row__ = type('%sRow' % name, (Row,), dict(__slots__=columns, __columns__=columns, __model__=model))
+        return model
 
 
 # 定义ORM所有映射的基类：Model
 # Model类的任意子类可以映射一个数据库表
+# 全部字段都已加载 / 加载后没有修改过的字段，所有实例共用
+_ALL_LOADED = frozenset()
+_CLEAN = frozenset()
+
 # Model类可以看作是对所有数据库表操作的基本定义的映射
 
 # 基于字典查询形式
 # Model从dict继承，拥有字典的所有功能，同时实现特殊方法__getattr__和__setattr__，能够实现属性操作
 # 实现数据库操作的所有方法，定义为class方法，所有继承自Model都具有数据库操作方法
 class Model(dict, metaclass=ModelMetaclass):
+    # 每个实例的状态放在slot中，不创建__dict__:
+    # __unloaded__: 投影查询时没有加载的字段
+    # __dirty__: 从数据库加载后被修改过的字段，None表示新建的实例，不知道哪些字段改过；
+    #            加载后是共用的_CLEAN，第一次修改字段时才创建set
+    __slots__ = ('__unloaded__', '__dirty__')
+    # 命名的投影，例如 __views__ = {'list': ('name', 'summary')}
+    __views__ = {}
+    # 为True时findAll默认返回紧凑的Row对象
+    __compact__ = False
+
+    def __new__(cls, *args, **kw):
+        m = dict.__new__(cls)
+        object.__setattr__(m, '__unloaded__', _ALL_LOADED)
+        object.__setattr__(m, '__dirty__', None)
+        return m
+
     def __init__(self, **kw):
         super(Model, self).__init__(**kw)
 
@@ -187,11 +983,65 @@ class Model(dict, metaclass=ModelMetaclass):
         try:
             return self[item]
         except KeyError:
+            if item in self.__unloaded__:
+                raise FieldNotLoadedError(r"'%s' object is partially loaded, field '%s' was not selected" % (self.__class__.__name__, item))
             raise AttributeError(r"'Model' object has no attribute '%s'" % item)
 
     def __setattr__(self, key, value):
         self[key]= value
 
+    def __setitem__(self, key, value):
+        dirty = self.__dirty__
+        if dirty is not None and key in self.__mappings__ and (key not in self or dict.__getitem__(self, key) != value):
+            if dirty is _CLEAN:
+                dirty = set()
+                object.__setattr__(self, '__dirty__', dirty)
+            dirty.add(key)
+        dict.__setitem__(self, key, value)
+
+    @classmethod
+    def _selectColumns(cls, columns):
+        ' return (select sql, selected columns, unloaded fields) for a projection given by column list or view name. '
+        if columns is None:
+            return cls.__select__, cls.__columns__, None
+        if isinstance(columns, str):
+            columns = cls.__views__[columns]
+        key = tuple(columns)
+        selected = cls.__selects__.get(key)
+        if selected is None:
+            for c in columns:
+                if c not in cls.__mappings__:
+                    raise ValueError('Invalid column: %s' % c)
+            # 主键总是加载，保证实例可以update/remove
+            names = tuple([cls.__primary_key__] + [c for c in columns if c != cls.__primary_key__])
+            sql = 'select %s from `%s`' % (', '.join(map(lambda f: '`%s`' % f, names)), cls.__table__)
+            selected = (sql, names, frozenset(cls.__mappings__.keys()) - frozenset(names))
+            cls.__selects__[key] = selected
+        return selected
+
+    @classmethod
+    def _fromRow(cls, r, unloaded=None):
+        m = cls(**r)
+        if unloaded:
+            object.__setattr__(m, '__unloaded__', unloaded)
+        object.__setattr__(m, '__dirty__', _CLEAN)
+        return m
+
+    @classmethod
+    def _fromTuple(cls, names, values, unloaded=None):
+        # 直接按列顺序填充，不经过中间的dict和**kw
+        m = cls.__new__(cls)
+        dict.update(m, zip(names, values))
+        if unloaded:
+            object.__setattr__(m, '__unloaded__', unloaded)
+        object.__setattr__(m, '__dirty__', _CLEAN)
+        return m
+
+    def _checkLoaded(self):
+        missing = [k for k in self.__unloaded__ if k not in self]
+        if missing:
+            raise FieldNotLoadedError(r"cannot write partially loaded '%s', fields not loaded: %s" % (self.__class__.__name__, ', '.join(sorted(missing))))
+
     def getValue(self, key):
         return getattr(self, key)
 
@@ -207,24 +1057,58 @@ class Model(dict, metaclass=ModelMetaclass):
 
     @classmethod  #类方法
     # 类方法有类变量cls传入，从而可以用cls做一些相关的处理。并且有子类继承时，调用该类方法时，传入的类变量cls是子类，而非父类。
-    async def find (cls, pk):
+    async def find (cls, pk, columns=None):
         ' find object by primary key. '
-        s1 = cls.__select__
-        s2 = cls.__primary_key__
-        rs = await select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
+        sql, names, unloaded = cls._selectColumns(columns)
+        rs = await select('%s where `%s`=?' % (sql, cls.__primary_key__), [pk], 1, tuples=True)
         if len(rs) == 0:
             return None
-        return cls(**rs[0])
+        return cls._fromTuple(names, rs[0], unloaded)
 
     @classmethod
-    async def findAll (cls, where=None, args=None, **kw):
-        sql = [cls.__select__]
+    async def find_many(cls, pks, columns=None):
+        ' find objects by primary keys in one query, returns a list in the order of pks with None for missing keys. '
+        pks = list(pks)
+        if not pks:
+            return []
+        keys = list(dict.fromkeys(pks))
+        sql, names, unloaded = cls._selectColumns(columns)
+        rs = await select('%s where `%s` in (%s)' % (sql, cls.__primary_key__, create_args_string(len(keys))), keys, tuples=True)
+        found = dict()
+        for r in rs:
+            # names[0]总是主键
+            found[r[0]] = cls._fromTuple(names, r, unloaded)
+        return [found.get(pk) for pk in pks]
+
+    @classmethod
+    async def load(cls, pk):
+        ' like find, but calls in the same event loop tick are batched into one find_many query. '
+        return await get_loader(cls).load(pk)
+
+    @classmethod
+    def _findAllSql(cls, where, args, kw):
+        ' build the select statement of findAll, returns (sql, args, selected columns, unloaded fields). '
         if where:
-            sql.append('where')
-            sql.append(where)
+            check_indexed(cls, where)
+        select_sql, names, unloaded = cls._selectColumns(kw.get('columns', None))
+        sql = [select_sql]
         if args is None:
             args = []
         orderBy = kw.get('orderBy', None)
+        after = kw.get('after', None)
+        before = kw.get('before', None)
+        if after is not None or before is not None:
+            # 游标(seek)分页: 按(seekBy, 主键)倒序，after取游标之后(更旧)的行，before取游标之前(更新)的行
+            # 不再使用limit offset，深分页不需要扫描并丢弃前面的行
+            seekBy = kw.get('seekBy', 'created_at')
+            key, op, direction = (after, '<', 'desc') if after is not None else (before, '>', 'asc')
+            seek = '(`%s` %s ? or (`%s` = ? and `%s` %s ?))' % (seekBy, op, seekBy, cls.__primary_key__, op)
+            where = '(%s) and %s' % (where, seek) if where else seek
+            args = list(args) + [key[0], key[0], key[1]]
+            orderBy = '`%s` %s, `%s` %s' % (seekBy, direction, cls.__primary_key__, direction)
+        if where:
+            sql.append('where')
+            sql.append(where)
         if orderBy:
             sql.append('order by')
             sql.append(orderBy)
@@ -239,33 +1123,139 @@ class Model(dict, metaclass=ModelMetaclass):
                 args.extend(limit)
             else:
                 raise ValueError('Invalid limit value: %s' % str(limit))
-        rs = await select(' '.join(sql), args)
-        return [cls(**r) for r in rs]
+        return ' '.join(sql), args, names, unloaded
+
+    @classmethod
+    async def findAll (cls, where=None, args=None, **kw):
+        sql, args, names, unloaded = cls._findAllSql(where, args, kw)
+        rs = await select(sql, args, tuples=True, cache=kw.get('cache', True))
+        if kw.get('after', None) is None and kw.get('before', None) is not None:
+            # before是正序查出来的，翻转回倒序
+            rs = rs[::-1]
+        if kw.get('compact', cls.__compact__):
+            row = cls.__row__
+            return [row._fromTuple(names, r) for r in rs]
+        fromTuple = cls._fromTuple
+        return [fromTuple(names, r, unloaded) for r in rs]
+
+    @classmethod
+    async def iter_all(cls, where=None, args=None, chunk_size=500, **kw):
+        '''
+        Iterate over all matching rows without loading them into memory, accepts the same keywords as findAll.
+        Holds a connection until exhausted or closed: wrap it in contextlib.aclosing() when stopping early.
+        '''
+        if kw.get('before', None) is not None:
+            raise ValueError('before is not supported by iter_all')
+        sql, args, names, unloaded = cls._findAllSql(where, args, kw)
+        compact = kw.get('compact', cls.__compact__)
+        # iter_all被关闭或取消时立即关闭select_iter，马上归还连接
+        async with contextlib.aclosing(select_iter(sql, args, chunk_size)) as chunks:
+            async for rs in chunks:
+                if compact:
+                    row = cls.__row__
+                    for r in rs:
+                        yield row._fromTuple(names, r)
+                else:
+                    for r in rs:
+                        yield cls._fromTuple(names, r, unloaded)
 
     @classmethod
-    async def findNumber(cls, selectField, where=None, args=None):
+    async def findNumber(cls, selectField, where=None, args=None, cache=True):
         sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
         if where:
             sql.append('where')
             sql.append(where)
-        rs = await select(' '.join(sql), args, 1)
+        rs = await select(' '.join(sql), args, 1, cache=cache)
         if len(rs) == 0:
             return None
         return rs[0]['_num_']
 
+    @classmethod
+    async def save_many(cls, rows, batch_size=100):
+        ' insert rows by multi-row insert statements, each batch in one transaction. '
+        rows = [r if isinstance(r, cls) else cls(**r) for r in rows]
+        values = ', (%s)' % create_args_string(len(cls.__fields__) + 1)
+        total = 0
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            args = []
+            for r in batch:
+                args.extend(map(r.getValueOrDefault, cls.__fields__))
+                args.append(r.getValueOrDefault(cls.__primary_key__))
+            # __insert__已经带有第一行的占位符
+            sql = cls.__insert__ + values * (len(batch) - 1)
+            t = time.time()
+            rows_affected = await execute(sql, args, autocommit=False)
+            logging.info('save_many %s: batch %s, %s rows in %.1f ms' % (cls.__table__, start // batch_size, rows_affected, (time.time() - t) * 1000))
+            if rows_affected != len(batch):
+                logging.warning('failed to insert batch: affected rows: %s of %s' % (rows_affected, len(batch)))
+            total = total + rows_affected
+        return total
+
+    @classmethod
+    async def findNumberCached(cls, selectField, where=None, args=None, ttl=60):
+        ' like findNumber, but the value is cached and refreshed in background once it is older than ttl seconds. '
+        key = (cls.__table__, selectField, where, tuple(args or ()))
+        entry = _number_cache.get(key)
+        if entry is None:
+            value = await cls.findNumber(selectField, where, args)
+            # [值, 过期时间, 正在刷新的task]
+            _number_cache[key] = [value, time.time() + ttl, None]
+            return value
+        if entry[1] < time.time() and entry[2] is None:
+            async def refresh():
+                try:
+                    entry[0] = await cls.findNumber(selectField, where, args)
+                    entry[1] = time.time() + ttl
+                except Exception as e:
+                    logging.exception(e)
+                finally:
+                    entry[2] = None
+            # 过期后先返回旧值，由后台task刷新
+            entry[2] = _spawn(refresh())
+        # 命中缓存时没有执行select，也要记下读过的表
+        _track((cls.__table__,))
+        return entry[0]
+
     async def save(self):
+        self._checkLoaded()
         args = list(map(self.getValueOrDefault, self.__fields__))
         args.append(self.getValueOrDefault(self.__primary_key__))
         rows = await execute(self.__insert__, args)
         if rows != 1:
             logging.warning('failed to update by primary key: affected rows: %s' % rows)
+        object.__setattr__(self, '__dirty__', _CLEAN)
+
+    @classmethod
+    def _updateSql(cls, fields):
+        ' return the update statement which sets only fields, cached by field set. '
+        sql = cls.__updates__.get(fields)
+        if sql is None:
+            sql = 'update `%s` set %s where `%s`=?' % (
+            cls.__table__, ', '.join(map(lambda f: '`%s`=?' % (cls.__mappings__.get(f).name or f), fields)), cls.__primary_key__)
+            cls.__updates__[fields] = sql
+        return sql
 
     async def update(self):
-        args = list(map(self.getValue, self.__fields__))
+        dirty = self.__dirty__
+        if dirty is None:
+            # 新建的实例，写入全部字段
+            self._checkLoaded()
+            fields = self.__fields__
+            sql = self.__update__
+        else:
+            # 只写入修改过的字段，按__fields__的顺序作为缓存的key
+            fields = tuple(f for f in self.__fields__ if f in dirty)
+            if not fields:
+                logging.debug('nothing to update: %s' % self.getValue(self.__primary_key__))
+                return
+            sql = self._updateSql(fields)
+        args = list(map(self.getValue, fields))
         args.append(self.getValue(self.__primary_key__))
-        rows = await execute(self.__update__, args)
+        rows = await execute(sql, args)
         if rows != 1:
             logging.warning('failed to update by primary key: affected rows: %s' % rows)
+        object.__setattr__(self, '__dirty__', _CLEAN)
 
     async def remove(self):
         args = self.getValue(self.__primary_key__)
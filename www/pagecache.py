@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Full-page cache of the pages anonymous visitors see, storing the encoded response body.
+
+Only the paths matched by RULES are cached; each rule gives the tag of the page, and the
+handlers writing the data of a page invalidate its tag:
+
+    www.pagecache.invalidate('index', 'blog:%s' % id)
+
+Concurrent misses of the same page wait for the first one instead of rendering it again,
+the cache is bounded by configs.page_cache.max_bytes. Invalidation is per process, other
+processes serve their copy until configs.page_cache.ttl expires.
+'''
+
+__author__ = 'wang shi wen'
+
+import asyncio, re, time
+from collections import OrderedDict
+
+from conf.config import configs
+
+# 可以缓存的页面: (路径的正则, tag)，tag中的%s是正则的第一个分组
+RULES = (
+    (re.compile(r'^/$'), 'index'),
+    (re.compile(r'^/blog/([^/]+)$'), 'blog:%s')
+)
+
+class CachedPage(object):
+
+    __slots__ = ('status', 'content_type', 'charset', 'body', 'tag', 'expires', 'etag', 'last_modified')
+
+    def __init__(self, status, content_type, charset, body, tag, expires, etag=None, last_modified=None):
+        self.status = status
+        self.content_type = content_type
+        self.charset = charset
+        self.body = body
+        self.tag = tag
+        self.expires = expires
+        self.etag = etag
+        self.last_modified = last_modified
+
+class PageCache(object):
+    '''
+    LRU cache of pages with ttl and a memory budget, entries of one tag can be dropped together.
+    '''
+
+    def __init__(self, ttl=60, max_bytes=32 * 1024 * 1024, max_entry_bytes=512 * 1024):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._data = OrderedDict()
+        # tag -> keys
+        self._tags = dict()
+        # tag -> 失效的次数，渲染期间tag失效的页面不再写入缓存
+        self._generations = dict()
+        # key -> future，正在渲染的页面
+        self._pending = dict()
+
+    def get(self, key):
+        page = self._data.get(key)
+        if page is None or page.expires < time.time():
+            if page is not None:
+                self._evict(key)
+            self.misses = self.misses + 1
+            return None
+        self._data.move_to_end(key)
+        self.hits = self.hits + 1
+        return page
+
+    def generation(self, tag):
+        return self._generations.get(tag, 0)
+
+    def put(self, key, page, generation):
+        size = len(page.body)
+        if size > self.max_entry_bytes or generation != self.generation(page.tag):
+            return
+        if key in self._data:
+            self._evict(key)
+        self._data[key] = page
+        self._tags.setdefault(page.tag, set()).add(key)
+        self.bytes = self.bytes + size
+        while self.bytes > self.max_bytes:
+            self.evictions = self.evictions + 1
+            self._evict(next(iter(self._data)))
+
+    def _evict(self, key):
+        page = self._data.pop(key, None)
+        if page is None:
+            return
+        self.bytes = self.bytes - len(page.body)
+        keys = self._tags.get(page.tag)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._tags[page.tag]
+
+    def invalidate(self, tag):
+        self._generations[tag] = self.generation(tag) + 1
+        keys = self._tags.pop(tag, None)
+        if keys:
+            self.invalidations = self.invalidations + 1
+            for key in keys:
+                page = self._data.pop(key, None)
+                if page is not None:
+                    self.bytes = self.bytes - len(page.body)
+
+    def clear(self):
+        self._data.clear()
+        self._tags.clear()
+        self.bytes = 0
+
+    async def get_or_render(self, key, tag, render):
+        '''
+        Return the cached page of key, or call render() once for all concurrent callers.
+        render returns (page, response): the page to cache (None if not cacheable) and the response.
+        Waiting callers get (page, None), or (None, None) if the page was not cacheable.
+        '''
+        page = self.get(key)
+        if page is not None:
+            return page, None
+        fut = self._pending.get(key)
+        if fut is not None:
+            self.waits = self.waits + 1
+            return await asyncio.shield(fut), None
+        fut = asyncio.get_event_loop().create_future()
+        self._pending[key] = fut
+        generation = self.generation(tag)
+        page = None
+        try:
+            page, r = await render()
+            if page is not None:
+                self.put(key, page, generation)
+            return page, r
+        finally:
+            del self._pending[key]
+            fut.set_result(page)
+
+    def stats(self):
+        n = self.hits + self.misses
+        return dict(entries=len(self._data), bytes=self.bytes, max_bytes=self.max_bytes, hits=self.hits, misses=self.misses,
+                    hit_rate=self.hits / n if n else 0.0, waits=self.waits, evictions=self.evictions, invalidations=self.invalidations)
+
+_config = configs['page_cache']
+_cache = PageCache(_config['ttl'], _config['max_bytes'], _config['max_entry_bytes'])
+
+def enabled():
+    return _config['enabled']
+
+def tag_of(path):
+    ' return the tag of path, None if it is not cached. '
+    for pattern, tag in RULES:
+        m = pattern.match(path)
+        if m is not None:
+            return tag % m.groups() if m.groups() else tag
+    return None
+
+def user_class(request):
+    # 只缓存匿名用户看到的页面，登录用户的页面带有用户名
+    return 'anonymous' if request.__user__ is None else None
+
+def cache():
+    return _cache
+
+def invalidate(*tags):
+    for tag in tags:
+        _cache.invalidate(tag)
+
+def stats():
+    return _cache.stats()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Markdown rendering with a content-addressed cache.
+'''
+
+import asyncio, hashlib, logging, functools, multiprocessing, contextvars
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import www.markdown2
+
+from conf.config import configs
+
+class RenderCache(object):
+    '''
+    Simple LRU cache for rendered html, keyed by content hash.
+    '''
+
+    def __init__(self, capacity=512):
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key):
+        html = self._data.get(key)
+        if html is None:
+            self.misses = self.misses + 1
+            return None
+        self._data.move_to_end(key)
+        self.hits = self.hits + 1
+        return html
+
+    def put(self, key, html):
+        self._data[key] = html
+        self._data.move_to_end(key)
+        while len(self._data) > self.capacity:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self):
+        return dict(entries=len(self._data), capacity=self.capacity, hits=self.hits, misses=self.misses)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __str__(self):
+        return 'size: %s, capacity: %s, hits: %s, misses: %s' % (len(self._data), self.capacity, self.hits, self.misses)
+
+    __repr__ = __str__
+
+_cache = RenderCache(configs['markdown']['cache_size'])
+_executor = None
+# 正在进程池中渲染的key，相同内容的并发请求共用一个future
+_pending = dict()
+# 当前请求(task)中超时改用纯文本的次数，由track_fallbacks()开启
+_fallbacks = contextvars.ContextVar('fallbacks', default=None)
+
+def track_fallbacks():
+    '''
+    Start recording timeouts of markdown_async in the current task, returns a list which gets
+    one entry per text returned as escaped plain text. Such responses must not be cached.
+    '''
+    fallbacks = []
+    _fallbacks.set(fallbacks)
+    return fallbacks
+
+def init_executor(workers=None):
+    '''
+    Create the process pool used by markdown_async. No pool is created if workers is 0.
+    '''
+    global _executor
+    if workers is None:
+        workers = configs['markdown']['workers']
+    if workers > 0:
+        logging.info('create markdown process pool: %s workers' % workers)
+        # 日志和sqlite都有后台线程，fork出的子进程可能继承被其他线程持有的锁，用forkserver启动
+        _executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver'))
+
+def _restart_executor():
+    # 子进程异常退出后进程池不能再用，换一个新的进程池
+    workers = _executor._max_workers
+    shutdown_executor()
+    init_executor(workers)
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
+
+def text2html(text):
+    '''
+    Escape text to plain html paragraphs, used when rendering takes too long.
+    '''
+    lines = map(lambda s: '<p>%s</p>' % s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;'), filter(lambda s: s.strip() != '', text.split('\n')))
+    return ''.join(lines)
+
+def cache_key(text, extras=None, **options):
+    '''
+    Hash the markdown source together with the extras and options used to render it.
+    '''
+    sha1 = hashlib.sha1()
+    sha1.update(text.encode('utf-8'))
+    sha1.update(b'\0')
+    sha1.update(repr(sorted(extras or ())).encode('utf-8'))
+    sha1.update(b'\0')
+    sha1.update(repr(sorted(options.items())).encode('utf-8'))
+    return sha1.hexdigest()
+
+def _convert(text, extras, options):
+    # 在子进程中执行，返回普通str以减少pickle的开销
+    return str(www.markdown2.markdown(text, extras=extras, **options))
+
+def _store(key, fut):
+    _pending.pop(key, None)
+    if not fut.cancelled() and fut.exception() is None:
+        _cache.put(key, fut.result())
+
+def markdown(text, extras=None, **options):
+    '''
+    Convert markdown to html, returning the cached result if the same text was rendered before.
+    '''
+    if not text:
+        return ''
+    key = cache_key(text, extras, **options)
+    html = _cache.get(key)
+    if html is None:
+        html = _convert(text, extras, options)
+        _cache.put(key, html)
+    return html
+
+async def markdown_async(text, extras=None, wait=False, **options):
+    '''
+    Like markdown(), but long text is converted in the process pool so the event loop is not blocked.
+    Returns escaped plain text if the conversion does not finish within configs.markdown.timeout
+    or the pool is broken, unless wait is True (used when the result is persisted), and records
+    it for track_fallbacks().
+    '''
+    if not text:
+        return ''
+    key = cache_key(text, extras, **options)
+    html = _cache.get(key)
+    if html is not None:
+        return html
+    if _executor is None or len(text) < configs['markdown']['inline_threshold']:
+        html = _convert(text, extras, options)
+        _cache.put(key, html)
+        return html
+    try:
+        fut = _pending.get(key)
+        if fut is None:
+            fut = asyncio.get_event_loop().run_in_executor(_executor, _convert, text, extras, options)
+            # 超时后子进程仍会完成渲染，结果照样写入缓存
+            fut.add_done_callback(functools.partial(_store, key))
+            _pending[key] = fut
+        if wait:
+            return await asyncio.shield(fut)
+        return await asyncio.wait_for(asyncio.shield(fut), configs['markdown']['timeout'])
+    except asyncio.TimeoutError:
+        logging.warning('markdown render timeout: %s chars' % len(text))
+    except BrokenProcessPool as e:
+        logging.error('markdown process pool broken: %s' % e)
+        if _executor is not None and getattr(_executor, '_broken', False):
+            _restart_executor()
+        if wait:
+            # 结果会被保存，不能用纯文本代替
+            return markdown(text, extras, **options)
+    fallbacks = _fallbacks.get()
+    if fallbacks is not None:
+        fallbacks.append(key)
+    return text2html(text)
+
+async def blog_html(blog):
+    '''
+    Return html of blog, preferring the persisted html_content column.
+    '''
+    html = blog.get('html_content')
+    if html:
+        return html
+    return await markdown_async(blog.content)
+
+def cache_info():
+    return _cache
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Generate CREATE TABLE / CREATE INDEX statements from the models, and diff them against a live database.
+
+Usage (from the project root):
+
+    python3 -m www.schema           # print the full schema
+    python3 -m www.schema --diff    # print statements to migrate the database in conf.config
+
+Statements are generated for configs.db.engine, e.g. create a local sqlite database with:
+
+    python3 -m www.schema | sqlite3 awesome.db
+
+--diff reads information_schema and only works with MySQL.
+'''
+
+__author__ = 'wang shi wen'
+
+import asyncio, logging, sys
+
+import www.orm
+from www.models import User, Blog, Comment, TableVersion
+
+from conf.config import configs
+
+MODELS = (User, Blog, Comment, TableVersion)
+
+def index_name(model, columns, unique=False):
+    return '%s_%s_%s' % ('uk' if unique else 'idx', model.__table__, '_'.join(columns))
+
+def _column_ddl(name, field):
+    return '`%s` %s not null' % (field.name or name, field.column_type)
+
+def create_table_sql(model, engine='mysql'):
+    '''
+    Return the create table statement of model, including its unique keys.
+    '''
+    lines = [_column_ddl(model.__primary_key__, model.__mappings__[model.__primary_key__])]
+    for f in model.__fields__:
+        lines.append(_column_ddl(f, model.__mappings__[f]))
+    # sqlite没有unique key语法，也没有engine和charset选项
+    unique = 'unique key `%s` (%s)' if engine == 'mysql' else 'constraint `%s` unique (%s)'
+    for columns in model.__unique__:
+        lines.append(unique % (index_name(model, columns, True), ', '.join('`%s`' % c for c in columns)))
+    lines.append('primary key (`%s`)' % model.__primary_key__)
+    options = ' engine=innodb default charset=utf8' if engine == 'mysql' else ''
+    return 'create table `%s` (\n    %s\n)%s;' % (model.__table__, ',\n    '.join(lines), options)
+
+def create_index_sql(model, columns, unique=False):
+    return 'create %sindex `%s` on `%s` (%s);' % ('unique ' if unique else '', index_name(model, columns, unique),
+                                                 model.__table__, ', '.join('`%s`' % c for c in columns))
+
+def schema_sql(models=MODELS, engine='mysql'):
+    L = []
+    for model in models:
+        L.append(create_table_sql(model, engine))
+        for columns in model.__indexes__:
+            L.append(create_index_sql(model, columns))
+    return L
+
+async def live_schema(database, models=MODELS):
+    '''
+    Load columns and indexes of the model tables from information_schema.
+    Returns {table: {'columns': {name: type}, 'indexes': {columns tuple: unique}}}.
+    '''
+    tables = [m.__table__ for m in models]
+    marks = ', '.join(['?'] * len(tables))
+    schema = dict((t, dict(columns=dict(), indexes=dict())) for t in tables)
+    rs = await www.orm.select('select table_name, column_name, column_type from information_schema.columns where table_schema=? and table_name in (%s)' % marks,
+                              [database] + tables, cache=False, tuples=True)
+    for table, column, column_type in rs:
+        schema[table]['columns'][column] = column_type
+    rs = await www.orm.select('select table_name, index_name, non_unique, column_name from information_schema.statistics where table_schema=? and table_name in (%s) order by table_name, index_name, seq_in_index' % marks,
+                              [database] + tables, cache=False, tuples=True)
+    indexes = dict()
+    for table, name, non_unique, column in rs:
+        indexes.setdefault((table, name, not non_unique), []).append(column)
+    for (table, name, unique), columns in indexes.items():
+        schema[table]['indexes'][tuple(columns)] = unique
+    return schema
+
+def _same_type(expected, actual):
+    # information_schema中boolean是tinyint(1)，real是double，bigint可能带显示宽度
+    expected = expected.lower()
+    actual = actual.lower()
+    if expected == 'boolean':
+        return actual.startswith('tinyint(1)')
+    if expected == 'real':
+        return actual == 'double'
+    if expected == 'bigint':
+        return actual.startswith('bigint')
+    return expected == actual
+
+def diff_sql(models, live):
+    '''
+    Return statements that bring the live schema in line with the models.
+    Columns and indexes which only exist in the database are reported as comments, never dropped.
+    '''
+    L = []
+    for model in models:
+        table = live.get(model.__table__)
+        if not table or not table['columns']:
+            L.append(create_table_sql(model))
+            for columns in model.__indexes__:
+                L.append(create_index_sql(model, columns))
+            continue
+        mappings = model.__mappings__
+        for name in (model.__primary_key__,) + tuple(model.__fields__):
+            column = mappings[name].name or name
+            actual = table['columns'].get(column)
+            if actual is None:
+                L.append('alter table `%s` add column %s;' % (model.__table__, _column_ddl(name, mappings[name])))
+            elif not _same_type(mappings[name].column_type, actual):
+                L.append('-- `%s`.`%s` is %s, model declares %s' % (model.__table__, column, actual, mappings[name].column_type))
+        for column in table['columns']:
+            if column not in mappings:
+                L.append('-- `%s`.`%s` is not mapped by %s' % (model.__table__, column, model.__name__))
+        for columns in model.__unique__:
+            if table['indexes'].get(columns) is not True:
+                L.append(create_index_sql(model, columns, True))
+        for columns in model.__indexes__:
+            if columns not in table['indexes']:
+                L.append(create_index_sql(model, columns))
+        declared = set(model.__indexes__ + model.__unique__ + [(model.__primary_key__,)])
+        for columns in table['indexes']:
+            if columns not in declared:
+                L.append('-- index (%s) on `%s` is not declared' % (', '.join(columns), model.__table__))
+    return L
+
+async def diff(loop):
+    db = configs['db']
+    if db.get('engine', 'mysql') != 'mysql':
+        raise ValueError('--diff only supports mysql')
+    await www.orm.create_pool(loop, **db)
+    live = await live_schema(db['database'])
+    return diff_sql(MODELS, live)
+
+if __name__ == '__main__':
+    if '--diff' in sys.argv[1:]:
+        loop = asyncio.get_event_loop()
+        L = loop.run_until_complete(diff(loop))
+        if not L:
+            logging.warning('schema is up to date.')
+    else:
+        L = schema_sql(engine=configs['db'].get('engine', 'mysql'))
+    for sql in L:
+        print(sql)
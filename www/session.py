@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Session tokens and the in-process cache of signed-in users.
+
+Session cookies are stateless tokens signed with HMAC-SHA256:
+
+    v2.<key id>.<base64 payload>.<base64 signature>
+
+The payload is the json list [id, name, image, admin, issued at (ms), expires (s)], so the auth
+middleware builds the current user without any database access. Tokens are signed with the key
+configs.session.key_id of configs.session.keys and verified with any key of keys: add a new key,
+switch key_id, and remove the old key once its tokens have expired.
+
+Legacy cookies (uid-expires-sha1 over the password hash) are still accepted until
+configs.session.legacy_until (unix time, None for no limit); they need User.load, the users
+are cached by the whole cookie for at most configs.session.cache_ttl seconds.
+
+User.update()/remove() invalidate the sessions of a user when its password or admin flag changes:
+cached legacy users are dropped and tokens issued before are rejected. This is per process,
+changes made with raw SQL, or seen by another process, only take effect when the tokens expire.
+'''
+
+__author__ = 'wang shi wen'
+
+import time, json, hmac, hashlib, base64
+from collections import OrderedDict
+
+from conf.config import configs
+
+class SessionCache(object):
+    '''
+    LRU cache of users with ttl, entries of one uid can be dropped together.
+    '''
+
+    def __init__(self, ttl=60, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        # key -> (user, expires)
+        self._data = OrderedDict()
+        # uid -> keys，用户可能同时在多个浏览器登录
+        self._keys = dict()
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None or entry[1] < time.time():
+            if entry is not None:
+                self._evict(key)
+            self.misses = self.misses + 1
+            return None
+        self._data.move_to_end(key)
+        self.hits = self.hits + 1
+        return entry[0]
+
+    def put(self, key, user, expires):
+        if self.ttl <= 0:
+            return
+        self._data[key] = (user, min(expires, time.time() + self.ttl))
+        self._data.move_to_end(key)
+        self._keys.setdefault(key[0], set()).add(key)
+        while len(self._data) > self.max_entries:
+            self._evict(next(iter(self._data)))
+
+    def _evict(self, key):
+        self._data.pop(key, None)
+        keys = self._keys.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys[key[0]]
+
+    def invalidate(self, uid):
+        keys = self._keys.pop(uid, None)
+        if keys:
+            self.invalidations = self.invalidations + 1
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+        self._keys.clear()
+
+    def stats(self):
+        n = self.hits + self.misses
+        return dict(entries=len(self._data), hits=self.hits, misses=self.misses,
+                    hit_rate=self.hits / n if n else 0.0, invalidations=self.invalidations)
+
+_cache = SessionCache(configs['session'].get('cache_ttl', 60), configs['session'].get('cache_size', 10000))
+_public_prefixes = tuple(configs['session'].get('public_prefixes', ('/static/',)))
+
+TOKEN_PREFIX = 'v2.'
+_keys = dict((kid, key.encode('utf-8')) for kid, key in configs['session'].get('keys', dict()).items())
+_key_id = configs['session'].get('key_id', None)
+# uid -> 会话失效的时间(ms)，之前签发的token不再接受
+_revoked = dict()
+
+def _b64encode(b):
+    return base64.urlsafe_b64encode(b).rstrip(b'=').decode('ascii')
+
+def _b64decode(s):
+    return base64.urlsafe_b64decode(s + '=' * (-len(s) % 4))
+
+def _sign(kid, payload):
+    # 截取128位，cookie短一些
+    return hmac.new(_keys[kid], ('%s%s.%s' % (TOKEN_PREFIX, kid, payload)).encode('ascii'), hashlib.sha256).digest()[:16]
+
+def encode_token(id, name, image, admin, max_age):
+    '''
+    Make a signed session token.
+
+    >>> claims = decode_token(encode_token('001', 'Michael', 'about:blank', True, 60))
+    >>> claims['id'], claims['name'], claims['admin']
+    ('001', 'Michael', True)
+    >>> decode_token(encode_token('001', 'Michael', 'about:blank', True, -1)) is None
+    True
+    '''
+    if _key_id not in _keys:
+        raise ValueError('session key %s is not configured' % _key_id)
+    now = time.time()
+    claims = [id, name, image, 1 if admin else 0, int(now * 1000), int(now + max_age)]
+    payload = _b64encode(json.dumps(claims, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+    return '%s%s.%s.%s' % (TOKEN_PREFIX, _key_id, payload, _b64encode(_sign(_key_id, payload)))
+
+def decode_token(token):
+    '''
+    Verify token and return its claims as a dict (id, name, image, admin, expires),
+    or None if it is malformed, badly signed, expired or revoked.
+    '''
+    if not token.startswith(TOKEN_PREFIX):
+        return None
+    L = token[len(TOKEN_PREFIX):].split('.')
+    if len(L) != 3:
+        return None
+    kid, payload, signature = L
+    if kid not in _keys:
+        return None
+    try:
+        if not hmac.compare_digest(_sign(kid, payload), _b64decode(signature)):
+            return None
+        id, name, image, admin, issued, expires = json.loads(_b64decode(payload).decode('utf-8'))
+    except (ValueError, TypeError):
+        return None
+    if expires < time.time():
+        return None
+    revoked = _revoked.get(id)
+    if revoked is not None and issued <= revoked:
+        return None
+    return dict(id=id, name=name, image=image, admin=bool(admin), expires=expires)
+
+def accept_legacy():
+    ' True if legacy cookies are still accepted. '
+    until = configs['session'].get('legacy_until', None)
+    return until is None or time.time() < until
+
+def get(key):
+    return _cache.get(key)
+
+def put(key, user, expires):
+    _cache.put(key, user, expires)
+
+def invalidate(uid):
+    ' drop the sessions of uid, e.g. after its password or admin flag changed. '
+    _cache.invalidate(uid)
+    now = int(time.time() * 1000)
+    if len(_revoked) > 10000:
+        # token的有效期不会超过一周，更早的记录不再需要
+        for k in [k for k, t in _revoked.items() if t < now - 7 * 86400 * 1000]:
+            del _revoked[k]
+    _revoked[uid] = now
+
+def is_public(path):
+    ' True if path needs no user, the auth middleware skips it. '
+    return path.startswith(_public_prefixes)
+
+def stats():
+    return _cache.stats()